@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""Benchmarks for the hot paths of bseditor.conv.
+
+Each operation is run against the bundled Bootstrap variables and against
+synthetically scaled variable files.  Wall time is the best of several
+runs, sass time is the portion of that run spent in the sass compiler and
+peak memory is measured in a separate traced run.
+
+Usage:
+
+    ./bench_conv.py [--sizes 1000,5000] [--save FILE] [--compare FILE]
+
+Results saved with --save can be given to --compare in a later run, any
+operation slower than the threshold causes a non-zero exit code.
+"""
+import argparse, gc, json, os, sys, tempfile, time
+
+try:
+    import tracemalloc
+except ImportError:     # pragma: no cover
+    sys.exit('tracemalloc is required, run with python 3')
+
+import sass
+
+from bench_memory import BOOTSTRAP_VARS, build_file
+from bseditor.conv import ordered_json, BStrapVars, base_cache
+
+DEFAULT_SIZES = '1000,5000,20000'
+
+# ============================================================================
+
+class SassTimer(object):
+    """Wraps sass.compile to accumulate the time spent in the compiler."""
+    def __init__(self):
+        self.elapsed = 0.0
+        self.original = sass.compile
+
+    def compile(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return self.original(*args, **kwargs)
+        finally:
+            self.elapsed += time.time() - start
+
+    def __enter__(self):
+        sass.compile = self.compile
+        return self
+
+    def __exit__(self, *args):
+        sass.compile = self.original
+
+
+def run(fn, setup, repeat):
+    # returns the best wall time, the sass time of that run and the peak
+    # memory of a separate traced run
+    best = None
+    for _ in range(repeat):
+        state = setup()
+        gc.collect()
+        with SassTimer() as timer:
+            start = time.time()
+            fn(state)
+            elapsed = time.time() - start
+
+        if best is None or elapsed < best[0]:
+            best = (elapsed, timer.elapsed)
+
+    state = setup()
+    gc.collect()
+    tracemalloc.start()
+    fn(state)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'wall':best[0],
+        'sass':best[1],
+        'peak':peak,
+    }
+
+
+def operations(filename):
+    # returns a list of (name, setup, fn) for the given variables file
+    bsv = BStrapVars.factory_from_sass_file(filename)
+    content = bsv.base_to_json()
+    stored = BStrapVars.factory(content).base_to_json(colours=True)
+    names = list(bsv.all_components.keys())
+    first = names[0]
+    custom = {first:'#123456'}
+
+    def cached(base):
+        def setup():
+            base_cache.clear()
+            BStrapVars.factory(base)
+
+        return setup
+
+    def loaded(base, custom=None):
+        def setup():
+            base_cache.clear()
+            return BStrapVars.factory(base, custom)
+
+        return setup
+
+    def nothing():
+        return None
+
+    def all_values(bsv):
+        for name in names:
+            bsv.get_value(name)
+
+    return [
+        ('factory_from_sass_file', nothing,
+            lambda state: BStrapVars.factory_from_sass_file(filename)),
+        ('factory', nothing,
+            lambda state: BStrapVars.factory(ordered_json(content))),
+        ('factory cached', cached(content),
+            lambda state: BStrapVars.factory(content, custom)),
+        ('detect_types', loaded(content),
+            lambda bsv: bsv.detect_types()),
+        ('detect_types stored', loaded(stored, custom),
+            lambda bsv: bsv.detect_types()),
+        ('dependencies', loaded(content, custom),
+            lambda bsv: bsv.dependencies(first)),
+        ('get_value', loaded(content, custom), all_values),
+        ('base_to_json', loaded(content), lambda bsv: bsv.base_to_json()),
+    ]
+
+
+def compare(results, baseline, threshold):
+    # prints the change against the baseline, returns True if any
+    # operation is slower than the threshold allows
+    print('\nCompared to baseline:')
+    failed = False
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+
+        before = baseline[key]['wall']
+        change = 0.0
+        if before:
+            change = (result['wall'] - before) / before * 100
+
+        flag = ''
+        if change > threshold:
+            flag = '  ** REGRESSION **'
+            failed = True
+
+        print('%-36s %+8.1f%%%s' % (key, change, flag))
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+        help='comma separated numbers of variables for the synthetic files')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='number of timed runs per operation')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline file to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0,
+        help='percentage slowdown that counts as a regression')
+    args = parser.parse_args()
+
+    datasets = [('bootstrap', BOOTSTRAP_VARS, False)]
+    for size in args.sizes.split(','):
+        size = size.strip()
+        if not size:
+            continue
+
+        handle, filename = tempfile.mkstemp(suffix='.scss')
+        os.close(handle)
+        build_file(filename, variables=int(size))
+        datasets.append((size, filename, True))
+
+    results = {}
+    print('%-36s %10s %10s %12s' % ('operation', 'wall ms', 'sass ms',
+        'peak KiB'))
+    try:
+        for label, filename, _ in datasets:
+            for name, setup, fn in operations(filename):
+                key = '%s/%s' % (label, name)
+                result = run(fn, setup, args.repeat)
+                results[key] = result
+                print('%-36s %10.2f %10.2f %12.1f' % (key,
+                    result['wall'] * 1000, result['sass'] * 1000,
+                    result['peak'] / 1024.0))
+    finally:
+        for _, filename, generated in datasets:
+            if generated:
+                os.remove(filename)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
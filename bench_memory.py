@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Memory benchmark for the variable containers.
+
+Builds a large variables file by repeating the bundled Bootstrap variables
+with renamed copies, then loads it many times and reports how much memory
+the resulting objects hold on to.
+
+Usage:
+
+    ./bench_memory.py [--copies N] [--loads N]
+"""
+import argparse, gc, os, re, sys, tempfile
+
+try:
+    import tracemalloc
+except ImportError:     # pragma: no cover
+    sys.exit('tracemalloc is required, run with python 3')
+
+from bseditor.conv import ordered_json, BStrapVars, base_cache
+
+BOOTSTRAP_VARS = os.path.abspath(os.path.join(os.path.dirname(__file__),
+    'bseditor/static/bseditor/sass/bootstrap-3.3.5/bootstrap/_variables.scss'))
+
+NAME = re.compile(r'\$([A-Za-z0-9_-]+)')
+SECTION = re.compile(r'^(//={2,3})(.*)$')
+
+# ============================================================================
+
+def rename(name, suffix):
+    # the asset helper is defined by the compiling code, leave it alone
+    if name == 'bootstrap-sass-asset-helper':
+        return '$' + name
+
+    return '$' + name + suffix
+
+
+def build_file(filename, copies=None, variables=None):
+    """Writes a variables file made of renamed copies of the Bootstrap
+    variables.
+
+    :param copies: number of complete copies to write
+    :param variables: stop once this many variables have been written,
+        copies are repeated as needed
+    """
+    with open(BOOTSTRAP_VARS) as f:
+        lines = f.readlines()
+
+    written = 0
+    count = 0
+    with open(filename, 'w') as f:
+        while True:
+            if copies is not None and count >= copies:
+                return
+
+            suffix = '-%d' % count
+            count += 1
+            for line in lines:
+                if variables is not None and line.startswith('$'):
+                    if written >= variables:
+                        return
+
+                    written += 1
+
+                line = NAME.sub(lambda m: rename(m.group(1), suffix), line)
+                line = SECTION.sub(lambda m: m.group(1) + m.group(2) + suffix,
+                    line)
+                f.write(line)
+
+
+def measure(title, fn, loads):
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    kept = [fn() for _ in range(loads)]
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    current -= start
+    peak -= start
+    print('%-28s %10.1f KiB held  %10.1f KiB peak  %8.1f KiB per load' % (
+        title, current / 1024.0, peak / 1024.0, current / 1024.0 / loads))
+    return kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--copies', type=int, default=20,
+        help='copies of the Bootstrap variables in the generated file')
+    parser.add_argument('--loads', type=int, default=50,
+        help='number of times each loader is run')
+    args = parser.parse_args()
+
+    handle, filename = tempfile.mkstemp(suffix='.scss')
+    os.close(handle)
+    try:
+        build_file(filename, args.copies)
+        bsv = BStrapVars.factory_from_sass_file(filename)
+        content = bsv.base_to_json()
+        print('%d variables, %d loads\n' % (len(bsv.all_components),
+            args.loads))
+
+        measure('sass file', lambda: BStrapVars.factory_from_sass_file(
+            filename), args.loads)
+
+        measure('uncached JSON', lambda: BStrapVars.factory(
+            ordered_json(content)), args.loads)
+
+        base_cache.clear()
+        name = next(iter(bsv.all_components))
+        measure('cached JSON + custom', lambda: BStrapVars.factory(content,
+            {name:'#fff'}), args.loads)
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
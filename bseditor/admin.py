@@ -1,9 +1,10 @@
 from django.contrib import admin
 from django.core.urlresolvers import reverse
+from django.db.models import BooleanField, Case, Value, When
 
 from awl.admintools import make_admin_obj_mixin
 
-from .models import Version, Sheet
+from .models import Version, Sheet, DeployJob
 
 # ============================================================================
 
@@ -26,13 +27,42 @@ class VersionAdmin(admin.ModelAdmin):
     show_actions.allow_tags = True
 
 
+class OutOfDateFilter(admin.SimpleListFilter):
+    title = 'deploy status'
+    parameter_name = 'out_of_date'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('yes', 'Out of date'),
+            ('no', 'Up to date'),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value() == 'yes':
+            return queryset.filter(Sheet.out_of_date_query())
+        if self.value() == 'no':
+            return queryset.exclude(Sheet.out_of_date_query())
+
+        return queryset
+
+
 mixin = make_admin_obj_mixin('Sheet')
 mixin.add_obj_link('show_version', 'version')
 
 @admin.register(Sheet)
 class SheetAdmin(admin.ModelAdmin, mixin):
-    list_display = ('id', 'name', 'show_version', 'updated', 'filename', 
-        'show_filedate', 'show_actions')
+    list_display = ('id', 'name', 'show_version', 'updated', 'filename',
+        'show_filedate', 'show_out_of_date', 'output_size',
+        'compile_duration', 'show_actions')
+    list_select_related = ('version', )
+    list_filter = (OutOfDateFilter, )
+
+    def get_queryset(self, request):
+        # deploy state is calculated by the database so it can be sorted on
+        qs = super(SheetAdmin, self).get_queryset(request)
+        return qs.annotate(out_of_date=Case(
+            When(Sheet.out_of_date_query(), then=Value(True)),
+            default=Value(False), output_field=BooleanField()))
 
     def show_actions(self, obj):
         actions = []
@@ -57,5 +87,34 @@ class SheetAdmin(admin.ModelAdmin, mixin):
             return '<i>no file</i>'
 
         return when
-    show_filedate.short_description = 'File Changed'
+    show_filedate.short_description = 'Deployed'
     show_filedate.allow_tags = True
+    show_filedate.admin_order_field = 'deployed'
+
+    def show_out_of_date(self, obj):
+        return getattr(obj, 'out_of_date', None)
+    show_out_of_date.short_description = 'Out of Date'
+    show_out_of_date.boolean = True
+    show_out_of_date.admin_order_field = 'out_of_date'
+
+
+mixin = make_admin_obj_mixin('DeployJob')
+mixin.add_obj_link('show_sheet', 'sheet')
+
+@admin.register(DeployJob)
+class DeployJobAdmin(admin.ModelAdmin, mixin):
+    list_display = ('id', 'show_sheet', 'status', 'created', 'started',
+        'finished', 'duration', 'message')
+    list_select_related = ('sheet', )
+    list_filter = ('status', )
+    readonly_fields = ('sheet', 'status', 'message', 'started', 'finished')
+
+    def has_add_permission(self, request):
+        # jobs are created by deploying a Sheet
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        # jobs lost by an exiting process would otherwise stay queued
+        DeployJob.expire_lost()
+        return super(DeployJobAdmin, self).changelist_view(request,
+            extra_context)
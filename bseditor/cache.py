@@ -0,0 +1,411 @@
+# bseditor.cache.py
+import hashlib, io, os, tempfile, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+import sass
+from six import text_type
+from wrench.utils import dynamic_load
+
+from .pool import get_pool
+
+try:
+    import fcntl
+except ImportError:
+    # not available on windows, cross-process locking is skipped
+    fcntl = None
+
+# ============================================================================
+# Compiled CSS Cache
+# ============================================================================
+#
+# Compiled CSS is stored under a digest of the Sass source that was compiled
+# along with a fingerprint of the source tree it imports.  Identical sets of
+# variables are therefore only ever compiled once, no matter which Sheet they
+# came from.  The store is configured through the BSEDITOR_COMPILE_CACHE
+# setting:
+#
+#   BSEDITOR_COMPILE_CACHE = {
+#       'STORE':'bseditor.cache.FileStore',
+#       'OPTIONS':{
+#           'directory':'/var/cache/bseditor',
+#           'max_size':100 * 1024 * 1024,
+#       },
+#   }
+#
+# If the setting isn't present an in-memory store is used, set it to None to
+# disable caching.
+
+DEFAULT_MAX_SIZE = 32 * 1024 * 1024
+
+DEFAULT_CONFIG = {
+    'STORE':'bseditor.cache.MemoryStore',
+}
+
+
+def _encode(value):
+    if isinstance(value, text_type):
+        return value.encode('utf-8')
+
+    return value
+
+
+def atomic_write(filename, content, mode=None):
+    """Writes bytes to a temporary file in the same directory and renames it
+    into place so readers never see a partial file.  The temporary file is
+    removed if the write or rename fails.
+
+    :param filename: file to write
+    :param content: bytes to write
+    :param mode: optional permissions to give the file
+    """
+    directory = os.path.dirname(filename)
+    handle, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(content)
+
+        if mode is not None:
+            os.chmod(temp, mode)
+
+        os.rename(temp, filename)
+    except Exception:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+
+        raise
+
+
+def compile_key(source, fingerprint=''):
+    """Returns the cache key for a piece of Sass source.
+
+    :param source: string containing the Sass to be compiled
+    :param fingerprint: string identifying the state of the files the source
+        imports
+    """
+    digest = hashlib.sha1(_encode(source))
+    digest.update(b'\0')
+    digest.update(_encode(fingerprint))
+    return digest.hexdigest()
+
+
+class MemoryStore(object):
+    """Keeps compiled CSS in a process wide LRU dictionary.
+
+    :param max_size: total number of characters of CSS to hold before the
+        least recently used entries are evicted
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return None
+
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_size and self._entries:
+                _, old = self._entries.popitem(last=False)
+                self.size -= len(old)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class FileStore(object):
+    """Keeps compiled CSS as files in a directory, which allows the cache to
+    be shared between processes.  Reading an entry updates its modification
+    time, the oldest entries are removed when the directory grows past its
+    maximum size.
+
+    :param directory: directory to store the files in, created if it doesn't
+        exist
+    :param max_size: total number of bytes to hold before the least
+        recently used entries are removed
+    """
+    suffix = '.css'
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with io.open(filename, 'rb') as f:
+                value = f.read()
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+
+        if not isinstance(value, str):
+            value = value.decode('utf-8')
+
+        return value
+
+    def set(self, key, value):
+        atomic_write(self._filename(key), _encode(value))
+
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                # removed by another process
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, filename))
+
+        return entries
+
+    def _evict(self):
+        entries = self._entries()
+        size = sum(entry[1] for entry in entries)
+        if size <= self.max_size:
+            return
+
+        for _, entry_size, filename in sorted(entries):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+            size -= entry_size
+            if size <= self.max_size:
+                return
+
+    def clear(self):
+        for _, _, filename in self._entries():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+class DjangoCacheStore(object):
+    """Keeps compiled CSS in one of the caches defined in the django
+    ``CACHES`` setting.  Eviction is handled by the cache backend.
+
+    :param alias: name of the django cache to use, defaults to "default"
+    :param timeout: expiry time in seconds for entries, defaults to None
+        meaning they never expire
+    :param prefix: string to put in front of each key
+    """
+    def __init__(self, alias='default', timeout=None, prefix='bseditor:'):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.cache.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.cache.set(self.prefix + key, value, self.timeout)
+
+    def clear(self):
+        # entries can't be told apart from the rest of the cache
+        pass
+
+
+_store_lock = threading.Lock()
+_store = None
+_store_config = None
+
+def get_store():
+    """Returns the store configured by the BSEDITOR_COMPILE_CACHE setting
+    or None if caching is disabled.  The store is created on first use and
+    re-created if the setting changes."""
+    global _store, _store_config
+
+    config = getattr(settings, 'BSEDITOR_COMPILE_CACHE', DEFAULT_CONFIG)
+    with _store_lock:
+        if _store_config != config:
+            _store = None
+            if config:
+                cls = dynamic_load(config['STORE'])
+                _store = cls(**config.get('OPTIONS', {}))
+
+            _store_config = config
+
+        return _store
+
+
+# ============================================================================
+# Single-Flight Compiles
+# ============================================================================
+#
+# Identical compiles that are requested at the same time (e.g. several staff
+# previewing the same sheet) are only run once, the other callers wait for
+# the result.  Within a process this is done with a lock per compile key,
+# processes can also coordinate through lock files in the directory named
+# by the BSEDITOR_COMPILE_LOCK_DIR setting.  Other processes only benefit
+# if the store is shared, e.g. FileStore or DjangoCacheStore.
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Runs a callable once for all the threads that ask for the same key
+    at the same time."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, fn):
+        """Returns the result of ``fn()``.  If another thread is already
+        running it for ``key`` waits and returns (or raises) that call's
+        result instead."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+            flight.done.set()
+
+        return flight.result
+
+
+flights = SingleFlight()
+
+
+@contextmanager
+def file_lock(key):
+    """Holds an exclusive lock file for the key in the directory named by
+    the BSEDITOR_COMPILE_LOCK_DIR setting, does nothing if the setting is
+    missing or the platform has no ``fcntl``.  Keys are striped over at most
+    256 lock files by their first two characters so the directory doesn't
+    grow with every compile, unrelated keys occasionally share a lock."""
+    directory = getattr(settings, 'BSEDITOR_COMPILE_LOCK_DIR', None)
+    if not directory or fcntl is None:
+        yield
+        return
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(os.path.join(directory, key[:2] + '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def compile_sass(source, fingerprint='', compile_source=None, splice=None,
+        pool=None):
+    """Compiles Sass source into CSS, returning the result from the cache
+    if the same source has been compiled before.  Concurrent requests for
+    the same compile share a single compile.
+
+    :param source: string containing the Sass to compile
+    :param fingerprint: string identifying the state of the files the source
+        imports, changing it invalidates the cached results
+    :param compile_source: optional equivalent of ``source`` that is given to
+        the compiler instead, for example with its imports expanded.  The
+        cache key is always based on ``source``.
+    :param splice: optional callable that is tried before the compiler, it
+        returns the CSS or None if the source has to be compiled, see
+        bseditor.splice
+    :param pool: optional :class:`bseditor.pool.CompilePool` to compile in
+        instead of the one configured in the settings
+    """
+    if compile_source is None:
+        compile_source = source
+
+    key = compile_key(source, fingerprint)
+    store = get_store()
+    if store is not None:
+        result = store.get(key)
+        if result is not None:
+            return result
+
+    def run():
+        with file_lock(key):
+            # another thread or process may have finished the compile while
+            # this one waited
+            if store is not None:
+                result = store.get(key)
+                if result is not None:
+                    return result
+
+            result = _compile(compile_source, splice, pool)
+            if store is not None:
+                store.set(key, result)
+
+            return result
+
+    return flights.do(key, run)
+
+
+def _compile(compile_source, splice, pool):
+    if splice is not None:
+        result = splice()
+        if result is not None:
+            return result
+
+    # heavy or runaway compiles can be kept out of the calling thread, see
+    # bseditor.pool
+    if pool is None:
+        pool = get_pool()
+
+    if pool is not None:
+        return pool.compile(compile_source)
+
+    return sass.compile(string=compile_source)
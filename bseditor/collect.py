@@ -0,0 +1,86 @@
+# bseditor.collect.py
+import os
+from collections import OrderedDict
+
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import (staticfiles_storage,
+    HashedFilesMixin, ManifestFilesMixin)
+from django.core.files.storage import FileSystemStorage
+
+# ============================================================================
+# Static Collection
+# ============================================================================
+#
+# collectstatic scans the static files of every app, for a deploy only the
+# one file written needs collecting.  To use it instead of collectstatic:
+#
+#   BSEDITOR_COLLECT_ON_DEPLOY = True
+#   BSEDITOR_COLLECT_HOOK = 'bseditor.collect.collect_sheet'
+#
+# BSEDITOR_DEPLOY_DIR has to be one of the STATICFILES_DIRS, as it does for
+# collectstatic.
+
+def static_name(filename):
+    """Returns the name a file in one of the STATICFILES_DIRS is collected
+    under, taking the optional prefix of the directory into account.
+
+    :param filename: absolute filename inside one of the STATICFILES_DIRS
+    """
+    filename = os.path.abspath(filename)
+    for prefix, root in finders.FileSystemFinder().locations:
+        root = os.path.abspath(root)
+        if os.path.dirname(filename) == root:
+            return os.path.join(prefix, os.path.basename(filename))
+
+    return os.path.basename(filename)
+
+
+def collect_file(filename, storage=None):
+    """Copies a single file into the static files storage the way
+    collectstatic would, including the post-processing done by hashing
+    storages.  Manifest storages have the entry for the file merged into
+    their existing manifest.  Returns the name the file is stored under.
+
+    :param filename: absolute filename inside one of the STATICFILES_DIRS
+    :param storage: storage to collect into, defaults to
+        ``staticfiles_storage``
+    """
+    if storage is None:
+        storage = staticfiles_storage
+
+    name = static_name(filename)
+    source = FileSystemStorage(location=os.path.dirname(filename))
+    source_name = os.path.basename(filename)
+
+    if storage.exists(name):
+        storage.delete(name)
+
+    with source.open(source_name) as f:
+        storage.save(name, f)
+
+    if not hasattr(storage, 'post_process'):
+        return name
+
+    paths = OrderedDict([(name, (source, source_name))])
+    if isinstance(storage, ManifestFilesMixin):
+        # the manifest version of post_process starts an empty manifest,
+        # hash just this file and merge it into what is already there
+        storage.hashed_files = storage.load_manifest()
+        processor = HashedFilesMixin.post_process(storage, paths)
+    else:
+        processor = storage.post_process(paths)
+
+    for _, _, processed in processor:
+        if isinstance(processed, Exception):
+            raise processed
+
+    if isinstance(storage, ManifestFilesMixin):
+        storage.save_manifest()
+
+    return name
+
+
+def collect_sheet(sheet):
+    """Collect hook for :class:`Sheet` deploys that only collects the
+    sheet's own file, see BSEDITOR_COLLECT_HOOK."""
+    collect_file(sheet.full_filename)
@@ -1,7 +1,7 @@
-import re, sass, json
+import hashlib, math, re, sass, json, threading
 from collections import OrderedDict
 
-from six import string_types
+from six import string_types, text_type
 
 from awl.css_colours import is_colour
 
@@ -10,30 +10,704 @@ from awl.css_colours import is_colour
 def ordered_json(content):
     return json.loads(content, object_pairs_hook=OrderedDict)
 
+
+# matches a sass variable reference, the name is everything that is legal in
+# a sass identifier so that "$gray-base" does not match "$gray-base-light"
+VARIABLE_REF = re.compile(r'\$([A-Za-z0-9_-]+)')
+
+def variable_refs(value):
+    """Returns a set of the names of the sass variables referenced in the
+    given value."""
+    return set(VARIABLE_REF.findall(value))
+
+# ============================================================================
+# Colour Expression Evaluator
+# ============================================================================
+
+# CSS colour names known to sass mapped to their RGB values
+COLOUR_NAMES = {
+    'aliceblue':0xf0f8ff, 'antiquewhite':0xfaebd7, 'aqua':0x00ffff,
+    'aquamarine':0x7fffd4, 'azure':0xf0ffff, 'beige':0xf5f5dc,
+    'bisque':0xffe4c4, 'black':0x000000, 'blanchedalmond':0xffebcd,
+    'blue':0x0000ff, 'blueviolet':0x8a2be2, 'brown':0xa52a2a,
+    'burlywood':0xdeb887, 'cadetblue':0x5f9ea0, 'chartreuse':0x7fff00,
+    'chocolate':0xd2691e, 'coral':0xff7f50, 'cornflowerblue':0x6495ed,
+    'cornsilk':0xfff8dc, 'crimson':0xdc143c, 'cyan':0x00ffff,
+    'darkblue':0x00008b, 'darkcyan':0x008b8b, 'darkgoldenrod':0xb8860b,
+    'darkgray':0xa9a9a9, 'darkgreen':0x006400, 'darkgrey':0xa9a9a9,
+    'darkkhaki':0xbdb76b, 'darkmagenta':0x8b008b, 'darkolivegreen':0x556b2f,
+    'darkorange':0xff8c00, 'darkorchid':0x9932cc, 'darkred':0x8b0000,
+    'darksalmon':0xe9967a, 'darkseagreen':0x8fbc8f, 'darkslateblue':0x483d8b,
+    'darkslategray':0x2f4f4f, 'darkslategrey':0x2f4f4f,
+    'darkturquoise':0x00ced1, 'darkviolet':0x9400d3, 'deeppink':0xff1493,
+    'deepskyblue':0x00bfff, 'dimgray':0x696969, 'dimgrey':0x696969,
+    'dodgerblue':0x1e90ff, 'firebrick':0xb22222, 'floralwhite':0xfffaf0,
+    'forestgreen':0x228b22, 'fuchsia':0xff00ff, 'gainsboro':0xdcdcdc,
+    'ghostwhite':0xf8f8ff, 'gold':0xffd700, 'goldenrod':0xdaa520,
+    'gray':0x808080, 'green':0x008000, 'greenyellow':0xadff2f,
+    'grey':0x808080, 'honeydew':0xf0fff0, 'hotpink':0xff69b4,
+    'indianred':0xcd5c5c, 'indigo':0x4b0082, 'ivory':0xfffff0,
+    'khaki':0xf0e68c, 'lavender':0xe6e6fa, 'lavenderblush':0xfff0f5,
+    'lawngreen':0x7cfc00, 'lemonchiffon':0xfffacd, 'lightblue':0xadd8e6,
+    'lightcoral':0xf08080, 'lightcyan':0xe0ffff,
+    'lightgoldenrodyellow':0xfafad2, 'lightgray':0xd3d3d3,
+    'lightgreen':0x90ee90, 'lightgrey':0xd3d3d3, 'lightpink':0xffb6c1,
+    'lightsalmon':0xffa07a, 'lightseagreen':0x20b2aa, 'lightskyblue':0x87cefa,
+    'lightslategray':0x778899, 'lightslategrey':0x778899,
+    'lightsteelblue':0xb0c4de, 'lightyellow':0xffffe0, 'lime':0x00ff00,
+    'limegreen':0x32cd32, 'linen':0xfaf0e6, 'magenta':0xff00ff,
+    'maroon':0x800000, 'mediumaquamarine':0x66cdaa, 'mediumblue':0x0000cd,
+    'mediumorchid':0xba55d3, 'mediumpurple':0x9370db,
+    'mediumseagreen':0x3cb371, 'mediumslateblue':0x7b68ee,
+    'mediumspringgreen':0x00fa9a, 'mediumturquoise':0x48d1cc,
+    'mediumvioletred':0xc71585, 'midnightblue':0x191970, 'mintcream':0xf5fffa,
+    'mistyrose':0xffe4e1, 'moccasin':0xffe4b5, 'navajowhite':0xffdead,
+    'navy':0x000080, 'oldlace':0xfdf5e6, 'olive':0x808000,
+    'olivedrab':0x6b8e23, 'orange':0xffa500, 'orangered':0xff4500,
+    'orchid':0xda70d6, 'palegoldenrod':0xeee8aa, 'palegreen':0x98fb98,
+    'paleturquoise':0xafeeee, 'palevioletred':0xdb7093, 'papayawhip':0xffefd5,
+    'peachpuff':0xffdab9, 'peru':0xcd853f, 'pink':0xffc0cb, 'plum':0xdda0dd,
+    'powderblue':0xb0e0e6, 'purple':0x800080, 'rebeccapurple':0x663399,
+    'red':0xff0000, 'rosybrown':0xbc8f8f, 'royalblue':0x4169e1,
+    'saddlebrown':0x8b4513, 'salmon':0xfa8072, 'sandybrown':0xf4a460,
+    'seagreen':0x2e8b57, 'seashell':0xfff5ee, 'sienna':0xa0522d,
+    'silver':0xc0c0c0, 'skyblue':0x87ceeb, 'slateblue':0x6a5acd,
+    'slategray':0x708090, 'slategrey':0x708090, 'snow':0xfffafa,
+    'springgreen':0x00ff7f, 'steelblue':0x4682b4, 'tan':0xd2b48c,
+    'teal':0x008080, 'thistle':0xd8bfd8, 'tomato':0xff6347,
+    'turquoise':0x40e0d0, 'violet':0xee82ee, 'wheat':0xf5deb3,
+    'white':0xffffff, 'whitesmoke':0xf5f5f5, 'yellow':0xffff00,
+    'yellowgreen':0x9acd32,
+}
+
+# when several names share a value sass outputs these ones
+PREFERRED_NAMES = ('cyan', 'magenta', 'gray', 'darkgray', 'darkslategray',
+    'dimgray', 'lightgray', 'lightslategray', 'slategray')
+
+COLOUR_TO_NAME = dict((value, name) for name, value in COLOUR_NAMES.items())
+COLOUR_TO_NAME.update((COLOUR_NAMES[name], name) for name in PREFERRED_NAMES)
+
+TOKENS = re.compile(r"""
+    (?P<space>\s+)
+    |(?P<string>"[^"\\#]*"|'[^'\\#]*')
+    |(?P<hex>\#[0-9a-fA-F]+\b)
+    |(?P<number>(?:\d+\.?\d*|\.\d+)(?:[a-zA-Z]+|%)?)
+    |(?P<var>\$[A-Za-z0-9_-]+)
+    |(?P<ident>-?[A-Za-z_][A-Za-z0-9_-]*)
+    |(?P<op>[-+*/(),])
+    """, re.VERBOSE)
+
+NUMBER_PARTS = re.compile(r'([0-9.]+)(.*)')
+
+
+class Unsupported(Exception):
+    """Raised by :class:`ColourEvaluator` when it can't resolve an
+    expression, those expressions need to be sent to the sass compiler."""
+    pass
+
+
+def sass_round(value):
+    # C style rounding, halves away from zero, as used by the sass compiler
+    if value < 0:
+        return -math.floor(-value + 0.5)
+
+    return math.floor(value + 0.5)
+
+
+def clip(value, low, high):
+    return min(max(value, low), high)
+
+
+def absmod(value, modulus):
+    result = math.fmod(value, modulus)
+    if result < 0:
+        result += modulus
+
+    return result
+
+
+class Colour(object):
+    """Colour value produced by the :class:`ColourEvaluator`.  Channels are
+    kept unrounded, as the sass compiler does, until they are output.
+
+    :param r: red channel, 0-255
+    :param g: green channel, 0-255
+    :param b: blue channel, 0-255
+    :param a: alpha channel, 0-1
+    :param text: literal text the colour was written as, sass outputs
+        unmodified literals as they were written
+    """
+    def __init__(self, r, g, b, a=1.0, text=''):
+        self.r = r
+        self.g = g
+        self.b = b
+        self.a = a
+        self.text = text
+
+    @classmethod
+    def from_hsl(cls, h, s, l, a=1.0):
+        hue = absmod(h / 360.0, 1.0)
+        sat = clip(s / 100.0, 0.0, 1.0)
+        light = clip(l / 100.0, 0.0, 1.0)
+
+        if light <= 0.5:
+            m2 = light * (sat + 1.0)
+        else:
+            m2 = (light + sat) - (light * sat)
+        m1 = (light * 2.0) - m2
+
+        def hue_to_rgb(hue):
+            hue = absmod(hue, 1.0)
+            if hue * 6.0 < 1:
+                return m1 + (m2 - m1) * hue * 6
+            if hue * 2.0 < 1:
+                return m2
+            if hue * 3.0 < 2:
+                return m1 + (m2 - m1) * (2.0 / 3.0 - hue) * 6
+            return m1
+
+        return Colour(hue_to_rgb(hue + 1.0 / 3.0) * 255.0,
+            hue_to_rgb(hue) * 255.0, hue_to_rgb(hue - 1.0 / 3.0) * 255.0, a)
+
+    def to_hsl(self):
+        """Returns a (hue, saturation, lightness) tuple for this colour with
+        hue in degrees and the others as percentages."""
+        r = self.r / 255.0
+        g = self.g / 255.0
+        b = self.b / 255.0
+        high = max(r, g, b)
+        low = min(r, g, b)
+        delta = high - low
+        l = (high + low) / 2.0
+
+        if abs(high - low) < 1e-12:
+            h = s = 0.0
+        else:
+            if l < 0.5:
+                s = delta / (high + low)
+            else:
+                s = delta / (2.0 - high - low)
+
+            if r == high:
+                h = (g - b) / delta + (6 if g < b else 0)
+            elif g == high:
+                h = (b - r) / delta + 2
+            else:
+                h = (r - g) / delta + 4
+
+        return (h * 60, s * 100, l * 100)
+
+    def to_css(self):
+        """Returns the colour as the sass compiler would output it."""
+        if self.text:
+            return self.text
+
+        r, g, b = [int(sass_round(clip(channel, 0, 255)))
+            for channel in (self.r, self.g, self.b)]
+        a = clip(self.a, 0, 1)
+
+        value = (r << 16) | (g << 8) | b
+        if a >= 1:
+            return COLOUR_TO_NAME.get(value, '#%06x' % value)
+
+        if a == 0 and value == 0:
+            return 'transparent'
+
+        return 'rgba(%d, %d, %d, %g)' % (r, g, b, a)
+
+
+class Number(object):
+    def __init__(self, value, unit=''):
+        self.value = value
+        self.unit = unit
+
+
+class Text(object):
+    """Any non-colour, non-number value: strings, identifiers and lists."""
+    def __init__(self, value):
+        self.value = value
+
+
+def from_sass_value(value, text=''):
+    """Converts a value passed from the sass compiler to a custom function
+    into the types used by :class:`ColourEvaluator`.
+
+    :param value: value passed to the custom function
+    :param text: optional text the compiler outputs for the value, colours
+        keep it so that they are written the way the compiler writes them
+    """
+    if isinstance(value, sass.SassColor):
+        return Colour(value.r, value.g, value.b, value.a, text)
+
+    if isinstance(value, sass.SassNumber):
+        unit = value.unit
+        if isinstance(unit, bytes):
+            unit = unit.decode('utf-8')
+
+        return Number(value.value, unit)
+
+    if isinstance(value, sass.SassList):
+        return Text([from_sass_value(item) for item in value.items])
+
+    if value is None or isinstance(value, bool):
+        return value
+
+    return Text(value)
+
+
+class ColourEvaluator(object):
+    """Pure python evaluator for the sass expressions commonly used in
+    Bootstrap variables: colour literals, variables, arithmetic on numbers and
+    the common colour functions.  Anything else raises :class:`Unsupported`
+    so that the caller can fall back to the sass compiler.
+    """
+    def __init__(self):
+        # the variable prefix used in every compile
+        self.env = {
+            'bootstrap-sass-asset-helper':False,
+        }
+
+    def define(self, name, value):
+        """Evaluates and stores the value of a variable for use by later
+        expressions.  Returns the evaluated value.
+
+        :raises Unsupported: if the expression can't be evaluated, the
+            variable is then marked so dependent expressions raise as well
+        """
+        try:
+            result = self.evaluate(value)
+        except Unsupported:
+            self.env[name] = Unsupported
+            raise
+
+        self.env[name] = result
+        return result
+
+    def evaluate(self, value):
+        """Evaluates a sass expression.
+
+        :returns: :class:`Colour`, :class:`Number`, :class:`Text`, a boolean
+            or None for null
+        :raises Unsupported: if the expression can't be evaluated
+        """
+        if '#{' in value or '!' in value:
+            raise Unsupported('interpolation and flags not supported')
+
+        self.tokens = []
+        pos = 0
+        while pos < len(value):
+            match = TOKENS.match(value, pos)
+            if not match:
+                raise Unsupported('unknown token at %s' % pos)
+
+            space_before = bool(self.tokens) and self.tokens[-1][0] == 'space'
+            kind = match.lastgroup
+            if kind == 'space':
+                if self.tokens and not space_before:
+                    self.tokens.append(('space', None))
+            else:
+                self.tokens.append((kind, match.group(kind)))
+
+            pos = match.end()
+
+        if self.tokens and self.tokens[-1][0] == 'space':
+            self.tokens.pop()
+
+        self.pos = 0
+        self.parens = 0
+        result = self._list()
+        if self.pos != len(self.tokens):
+            raise Unsupported('unexpected tokens')
+
+        return result
+
+    # --- tokens
+    def _peek(self, skip_space=True):
+        pos = self.pos
+        if skip_space and pos < len(self.tokens) and \
+                self.tokens[pos][0] == 'space':
+            pos += 1
+
+        if pos < len(self.tokens):
+            return self.tokens[pos]
+        return (None, None)
+
+    def _next(self):
+        if self.pos < len(self.tokens) and self.tokens[self.pos][0] == 'space':
+            self.pos += 1
+
+        if self.pos >= len(self.tokens):
+            raise Unsupported('unexpected end of expression')
+
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def _spaced(self):
+        # True if the next token is preceded by a space
+        return self.pos < len(self.tokens) and \
+            self.tokens[self.pos][0] == 'space'
+
+    # --- grammar
+    def _list(self):
+        # comma separated list of space separated lists
+        items = [self._space_list()]
+        while self._peek() == ('op', ','):
+            self._next()
+            items.append(self._space_list())
+
+        if len(items) == 1:
+            return items[0]
+
+        return Text(items)
+
+    def _space_list(self):
+        items = [self._additive()]
+        while self._peek()[0] is not None and \
+                self._peek() not in (('op', ','), ('op', ')')):
+            items.append(self._additive())
+
+        if len(items) == 1:
+            return items[0]
+
+        return Text(items)
+
+    def _additive(self):
+        left = self._multiplicative()[0]
+        while self._peek()[1] in ('+', '-') and self._peek()[0] == 'op':
+            spaced = self._spaced()
+            op = self._next()[1]
+            if spaced and not self._spaced():
+                # "$a -1" is a list in sass, not a subtraction
+                raise Unsupported('ambiguous operator')
+
+            right = self._multiplicative()[0]
+            left = self._arithmetic(op, left, right)
+
+        return left
+
+    def _multiplicative(self):
+        left, literal = self._unary()
+        while self._peek()[1] in ('*', '/') and self._peek()[0] == 'op':
+            op = self._next()[1]
+            right, right_literal = self._unary()
+            if op == '/' and literal and right_literal and not self.parens:
+                # "12px/1.5" outside of parens is not a division in sass
+                raise Unsupported('slash separated values')
+
+            left = self._arithmetic(op, left, right)
+            literal = False
+
+        return left, literal
+
+    def _unary(self):
+        if self._peek() == ('op', '-'):
+            self._next()
+            value, literal = self._primary()
+            if not isinstance(value, Number):
+                raise Unsupported('negation of non-number')
+
+            return Number(-value.value, value.unit), literal
+
+        return self._primary()
+
+    def _primary(self):
+        kind, token = self._next()
+        if kind == 'number':
+            number, unit = NUMBER_PARTS.match(token).groups()
+            return Number(float(number), unit), True
+
+        if kind == 'hex':
+            digits = token[1:]
+            if len(digits) == 3:
+                digits = ''.join(c * 2 for c in digits)
+            elif len(digits) != 6:
+                raise Unsupported('unknown hex colour format')
+
+            value = int(digits, 16)
+            return Colour(value >> 16, (value >> 8) & 0xff, value & 0xff,
+                text=token), True
+
+        if kind == 'var':
+            try:
+                value = self.env[token[1:]]
+            except KeyError:
+                raise Unsupported('undefined variable %s' % token)
+
+            if value is Unsupported:
+                raise Unsupported('unresolved variable %s' % token)
+
+            return value, False
+
+        if kind == 'string':
+            return Text(token), True
+
+        if kind == 'ident':
+            if self._peek(skip_space=False) == ('op', '('):
+                self._next()
+                return self._function(token), False
+
+            if token in COLOUR_NAMES:
+                value = COLOUR_NAMES[token]
+                return Colour(value >> 16, (value >> 8) & 0xff, value & 0xff,
+                    text=token), True
+
+            if token == 'transparent':
+                return Colour(0, 0, 0, 0, text=token), True
+
+            if token.lower() in COLOUR_NAMES:
+                raise Unsupported('mixed case colour name')
+
+            if token in ('true', 'false'):
+                return token == 'true', True
+
+            if token == 'null':
+                return None, True
+
+            return Text(token), True
+
+        if (kind, token) == ('op', '('):
+            self.parens += 1
+            value = self._list()
+            self.parens -= 1
+            if self._next() != ('op', ')'):
+                raise Unsupported('unbalanced parens')
+
+            return value, False
+
+        raise Unsupported('unexpected token %s' % token)
+
+    def _function(self, name):
+        args = []
+        if self._peek() == ('op', ')'):
+            self._next()
+        else:
+            while True:
+                args.append(self._space_list())
+                kind, token = self._next()
+                if token == ')':
+                    break
+                if token != ',':
+                    raise Unsupported('bad argument list')
+
+        try:
+            handler = getattr(self, '_fn_' + name.replace('-', '_'))
+        except AttributeError:
+            raise Unsupported('unknown function %s' % name)
+
+        try:
+            return handler(*args)
+        except TypeError:
+            raise Unsupported('wrong number of arguments to %s' % name)
+
+    # --- argument helpers
+    def _arithmetic(self, op, left, right):
+        if not isinstance(left, Number) or not isinstance(right, Number):
+            raise Unsupported('arithmetic on non-numbers')
+
+        if op in ('+', '-'):
+            if left.unit and right.unit and left.unit != right.unit:
+                raise Unsupported('incompatible units')
+
+            unit = left.unit or right.unit
+            if op == '+':
+                return Number(left.value + right.value, unit)
+            return Number(left.value - right.value, unit)
+
+        if op == '*':
+            if left.unit and right.unit:
+                raise Unsupported('multiplied units')
+
+            return Number(left.value * right.value, left.unit or right.unit)
+
+        # division
+        if right.value == 0:
+            raise Unsupported('division by zero')
+
+        if left.unit == right.unit:
+            return Number(left.value / right.value)
+        if not right.unit:
+            return Number(left.value / right.value, left.unit)
+
+        raise Unsupported('divided units')
+
+    def _colour(self, value):
+        if not isinstance(value, Colour):
+            raise Unsupported('expected colour')
+
+        return value
+
+    def _number(self, value, low=None, high=None, units=('',)):
+        if not isinstance(value, Number) or value.unit not in units:
+            raise Unsupported('expected number')
+
+        if (low is not None and value.value < low) or \
+                (high is not None and value.value > high):
+            raise Unsupported('number out of range')
+
+        return value.value
+
+    def _percentage(self, value):
+        # amounts for the adjustment functions, with or without "%"
+        return self._number(value, 0, 100, ('', '%'))
+
+    def _factor(self, value):
+        return self._number(value, 0, 1)
+
+    def _channel(self, value):
+        # the pinned libsass doesn't scale percentage channels the way the
+        # sass spec does, leave them to the compiler so the editor agrees
+        # with the CSS
+        if isinstance(value, Number) and value.unit == '%':
+            raise Unsupported('percentage colour channel')
+
+        return self._number(value, 0, 255)
+
+    def _adjust_hsl(self, colour, h=0, s=0, l=0):
+        colour = self._colour(colour)
+        hue, sat, light = colour.to_hsl()
+        return Colour.from_hsl(absmod(hue + h, 360), clip(sat + s, 0, 100),
+            clip(light + l, 0, 100), colour.a)
+
+    # --- sass functions
+    def _fn_rgb(self, r, g, b):
+        return Colour(self._channel(r), self._channel(g), self._channel(b))
+
+    def _fn_rgba(self, *args):
+        if len(args) == 2:
+            colour = self._colour(args[0])
+            return Colour(colour.r, colour.g, colour.b, self._factor(args[1]))
+
+        if len(args) != 4:
+            raise Unsupported('bad rgba() arguments')
+
+        return Colour(self._channel(args[0]), self._channel(args[1]),
+            self._channel(args[2]), self._factor(args[3]))
+
+    def _fn_hsl(self, h, s, l):
+        return self._fn_hsla(h, s, l, Number(1))
+
+    def _fn_hsla(self, h, s, l, a):
+        return Colour.from_hsl(self._number(h, units=('', 'deg')),
+            self._percentage(s), self._percentage(l), self._factor(a))
+
+    def _fn_lighten(self, colour, amount):
+        return self._adjust_hsl(colour, l=self._percentage(amount))
+
+    def _fn_darken(self, colour, amount):
+        return self._adjust_hsl(colour, l=-self._percentage(amount))
+
+    def _fn_saturate(self, colour, amount):
+        return self._adjust_hsl(colour, s=self._percentage(amount))
+
+    def _fn_desaturate(self, colour, amount):
+        return self._adjust_hsl(colour, s=-self._percentage(amount))
+
+    def _fn_adjust_hue(self, colour, degrees):
+        return self._adjust_hsl(colour, h=self._number(degrees,
+            units=('', 'deg')))
+
+    def _fn_complement(self, colour):
+        return self._adjust_hsl(colour, h=180)
+
+    def _fn_grayscale(self, colour):
+        colour = self._colour(colour)
+        hue, sat, light = colour.to_hsl()
+        return Colour.from_hsl(hue, 0, light, colour.a)
+
+    def _fn_invert(self, colour):
+        colour = self._colour(colour)
+        return Colour(255 - colour.r, 255 - colour.g, 255 - colour.b,
+            colour.a)
+
+    def _fn_mix(self, colour1, colour2, weight=Number(50, '%')):
+        colour1 = self._colour(colour1)
+        colour2 = self._colour(colour2)
+        p = self._percentage(weight) / 100.0
+        w = 2 * p - 1
+        a = colour1.a - colour2.a
+
+        if w * a == -1:
+            w1 = (w + 1) / 2.0
+        else:
+            w1 = ((w + a) / (1 + w * a) + 1) / 2.0
+        w2 = 1 - w1
+
+        def channel(c1, c2):
+            return sass_round(w1 * c1 + w2 * c2)
+
+        return Colour(channel(colour1.r, colour2.r),
+            channel(colour1.g, colour2.g), channel(colour1.b, colour2.b),
+            colour1.a * p + colour2.a * (1 - p))
+
+    def _fn_opacify(self, colour, amount):
+        colour = self._colour(colour)
+        return Colour(colour.r, colour.g, colour.b,
+            clip(colour.a + self._factor(amount), 0, 1))
+
+    _fn_fade_in = _fn_opacify
+
+    def _fn_transparentize(self, colour, amount):
+        colour = self._colour(colour)
+        return Colour(colour.r, colour.g, colour.b,
+            clip(colour.a - self._factor(amount), 0, 1))
+
+    _fn_fade_out = _fn_transparentize
+
+    def _rounding(self, value, fn):
+        if not isinstance(value, Number):
+            raise Unsupported('expected number')
+
+        return Number(fn(value.value), value.unit)
+
+    def _fn_ceil(self, value):
+        return self._rounding(value, math.ceil)
+
+    def _fn_floor(self, value):
+        return self._rounding(value, math.floor)
+
+    def _fn_round(self, value):
+        return self._rounding(value, sass_round)
+
+    def _fn_percentage(self, value):
+        return Number(self._number(value) * 100, '%')
+
+    def _fn_if(self, condition, if_true, if_false):
+        if condition is False or condition is None:
+            return if_false
+
+        return if_true
+
 # ============================================================================
 # Container Classes
 # ============================================================================
 
 class Component(object):
+    __slots__ = ('name', 'info', 'value')
+
     def __init__(self, name, value, info=''):
         self.name = name
         self.info = info
 
-        # normalize value to the bare portion we use
+        # normalize value to the bare portion we use, values that have been
+        # serialized are already bare so skip the slicing when possible
         value = value.strip()
-        i = value.find('!default')
-        if i > -1:
-            value = value[0:i - 1] + value[i + 8:]
+        if '!default' in value or '//' in value or ';' in value:
+            i = value.find('!default')
+            if i > -1:
+                value = value[0:i - 1] + value[i + 8:]
+
+            i = value.find('//')
+            if i > -1:
+                value = value[0:i]
 
-        i = value.find('//')
-        if i > -1:
-            value = value[0:i]
+            i = value.find(';')
+            if i > -1:
+                value = value[0:i]
 
-        i = value.find(';')
-        if i > -1:
-            value = value[0:i]
+            value = value.strip()
 
-        self.value = value.strip()
+        self.value = value
 
     def to_dict(self):
         d = OrderedDict()
@@ -47,6 +721,8 @@ class Component(object):
 
 
 class Section(object):
+    __slots__ = ('parent', 'name', 'components', 'info')
+
     def __init__(self, parent, name, info=''):
         self.parent = parent
         self.name = name
@@ -75,35 +751,287 @@ class Section(object):
         return d
 
 
-class BStrapVars(object):
-    # -- CSS matching expression
-    #
-    # Typical pattern to match:
-    #
-    #  .component-offset-horizontal {
-    #     color: 180px; }
-    #
-    css_pieces = re.compile(
+class DependencyGraph(object):
+    """Tokenized reference graph between a set of sass variables.  Forward
+    edges map a variable to the variables its value references, reverse edges
+    map a variable to the variables whose values reference it.  Transitive
+    closures are calculated on demand and cached.
+
+    :param value_pairs: iterable of name/value pairs to build the graph from
+    """
+    __slots__ = ('references', 'dependents', '_base', '_dependents_closure',
+        '_references_closure')
+
+    def __init__(self, value_pairs):
+        self.references = OrderedDict()
+        self.dependents = OrderedDict()
+        self._base = None
+        self._dependents_closure = {}
+        self._references_closure = {}
+
+        for name, value in value_pairs:
+            self.dependents.setdefault(name, set([]))
+            refs = variable_refs(value)
+            self.references[name] = refs
+            for ref in refs:
+                self.dependents.setdefault(ref, set([])).add(name)
+
+    def patched(self, changes):
+        """Returns a new graph where the given variables have new values.
+        Only the edges touched by the changes are stored in the new graph,
+        everything else is looked up in this one, so this graph must not be
+        modified afterwards.
+
+        :param changes: dict of variable names to their new values, names
+            that aren't in this graph are ignored
         """
-        \.                # starts with period
-        ([^\s]*)          # css class name everything up to white space
-        [^:]*:            # eat everything up to first ":"
-        \s*               # eat whitespace
-        ([^;]*)           # value is everything up to first ";"
-        .*\}              # eat everything up to the closing }
-        """, re.VERBOSE)
+        graph = DependencyGraph(())
+        graph._base = self
+
+        for name, value in changes.items():
+            if name not in self.references:
+                continue
+
+            old = graph.get_references(name)
+            new = variable_refs(value)
+            graph.references[name] = new
+
+            for ref in old - new:
+                graph.dependents[ref] = graph.get_dependents(ref) - set([name])
+
+            for ref in new - old:
+                graph.dependents[ref] = graph.get_dependents(ref) | set([name])
+
+        return graph
+
+    def _lookup(self, kind, name):
+        graph = self
+        while graph is not None:
+            edges = getattr(graph, kind)
+            if name in edges:
+                return edges[name]
+
+            graph = graph._base
+
+        return set([])
+
+    def get_references(self, name):
+        """Returns the set of names directly referenced by the given
+        variable."""
+        return self._lookup('references', name)
+
+    def get_dependents(self, name):
+        """Returns the set of names that directly reference the given
+        variable."""
+        return self._lookup('dependents', name)
+
+    def _closure(self, name, edges, cache):
+        try:
+            return cache[name]
+        except KeyError:
+            pass
+
+        result = set([])
+        pending = [name]
+        while pending:
+            for found in edges(pending.pop()):
+                if found not in result:
+                    result.add(found)
+                    pending.append(found)
+
+        result.discard(name)
+        cache[name] = frozenset(result)
+        return cache[name]
+
+    def all_dependents(self, name):
+        """Returns a frozenset of the names of every variable that depends on
+        the given variable, including cascaded dependencies."""
+        return self._closure(name, self.get_dependents,
+            self._dependents_closure)
+
+    def all_references(self, name):
+        """Returns a frozenset of the names of every variable the given
+        variable requires in order to be evaluated, including cascaded
+        references."""
+        return self._closure(name, self.get_references,
+            self._references_closure)
+
+    def adjacency(self):
+        """Returns an OrderedDict of each variable that has dependents
+        mapped to a sorted list of the variables directly referencing it.
+        This is the compact form of the reverse edges sent to the editor,
+        closures are left for the client to compute."""
+        names = set([])
+        graph = self
+        while graph is not None:
+            names.update(graph.dependents.keys())
+            graph = graph._base
+
+        result = OrderedDict()
+        for name in sorted(names):
+            dependents = self.get_dependents(name)
+            if dependents:
+                result[name] = sorted(dependents)
+
+        return result
+
+
+class BaseCache(object):
+    """Process wide, bounded LRU cache of parsed base variables.  Entries are
+    keyed by a digest of the JSON they were parsed from so that changes to a
+    :class:`Version` never return stale content.
+
+    :param size: maximum number of entries to hold before the least recently
+        used one is evicted
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def digest(cls, content):
+        if isinstance(content, text_type):
+            content = content.encode('utf-8')
+
+        return hashlib.sha1(content).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            # re-insert to mark as most recently used
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def info(self):
+        """Returns a dict with the hit, miss and eviction counts as well as
+        the current and maximum size of the cache."""
+        return {
+            'hits':self.hits,
+            'misses':self.misses,
+            'evictions':self.evictions,
+            'size':len(self._entries),
+            'max_size':self.size,
+        }
+
+# cache shared by all calls to BStrapVars.factory()
+base_cache = BaseCache()
+
+
+class BaseVars(object):
+    """Sections and components of a set of base variables without any
+    customizations.  A single BaseVars is shared by every :class:`BStrapVars`
+    built from the same content, so once it has been handed out it is frozen
+    and can no longer be changed.
+    """
+    __slots__ = ('sections', 'nonsections', 'all_components', 'colours',
+        'frozen', '_graph')
 
     def __init__(self):
         self.sections = OrderedDict()
         self.nonsections = OrderedDict()
         self.all_components = OrderedDict()
+        self.colours = None
+        self.frozen = False
+        self._graph = None
+
+    def freeze(self):
+        """Prevents further changes to this object and returns it."""
+        self.frozen = True
+        return self
+
+    def add_section(self, name, info=''):
+        if self.frozen:
+            raise TypeError('Base variables are frozen and cannot be changed')
+
+        section = Section(self, name, info)
+        self.sections[name] = section
+        return section
+
+    def add_component(self, name, value, info=''):
+        if self.frozen:
+            raise TypeError('Base variables are frozen and cannot be changed')
+
+        component = Component(name, value, info)
+        self.nonsections[name] = component
+        self.all_components[name] = component
+        return component
+
+    @property
+    def graph(self):
+        """:class:`DependencyGraph` of the base values of the components.
+        The graph is only kept once the object is frozen, until then the
+        components may still change."""
+        if self._graph is not None:
+            return self._graph
+
+        graph = DependencyGraph((comp.name, comp.value) for comp in
+            self.all_components.values())
+        if self.frozen:
+            self._graph = graph
+
+        return graph
+
 
+class BStrapVars(object):
+    __slots__ = ('base', 'custom_values', 'override_values', '_colour_values',
+        '_graph')
+
+    def __init__(self, base=None):
+        if base is None:
+            base = BaseVars()
+
+        self.base = base
         self.custom_values = OrderedDict()
         self.override_values = OrderedDict()
-        self.colour_values = OrderedDict()
+        self._colour_values = None
+        self._graph = None
+
+    @property
+    def sections(self):
+        return self.base.sections
+
+    @property
+    def nonsections(self):
+        return self.base.nonsections
+
+    @property
+    def all_components(self):
+        return self.base.all_components
+
+    @property
+    def base_colours(self):
+        return self.base.colours
 
     @classmethod
-    def factory(cls, base, custom=None, overrides=None):
+    def factory(cls, base, custom=None, overrides=None, eager=False):
         """
         Constructs a BootStrap Sass variables container that stores three
         types of data: default base variables for BootStrap Sass ordered by
@@ -169,26 +1097,23 @@ class BStrapVars(object):
             use instead of those found in the base or a JSON reprsentation of
             same
         :param overrides: a dict of name/value pairs 
+        :param eager: colour types are normally detected on the first access
+            of :attr:`colour_values`, set this to True to detect them
+            immediately instead.  Defaults to False.
         """
-        bstrap_vars = BStrapVars()
-
-        # handle both JSON strings and dictionaries
+        # handle both JSON strings and dictionaries, parsed JSON strings are
+        # kept in the process wide :class:`BaseCache` so repeated requests
+        # against the same content only build the custom and override layers
         if isinstance(base, string_types):
-            base = ordered_json(base)
-
-        sections = base.get('sections', {})
-        for name, section_enc in sections.items():
-            info = section_enc.get('info', '')
-            section = bstrap_vars.add_section(name, info)
-            components = section_enc.get('components', {})
-            for comp_name, comp in components.items():
-                info = comp.get('info', '')
-                section.add_component(comp_name, comp['value'], info)
+            key = BaseCache.digest(base)
+            parsed = base_cache.get(key)
+            if parsed is None:
+                parsed = cls._parse_base(ordered_json(base)).freeze()
+                base_cache.put(key, parsed)
+        else:
+            parsed = cls._parse_base(base)
 
-        nonsections = base.get('nonsections', {})
-        for name, comp in nonsections.items():
-            info = comp.get('info', '')
-            bstrap_vars.add_component(name, comp['value'], info)
+        bstrap_vars = BStrapVars(parsed)
 
         if isinstance(custom, string_types):
             custom = ordered_json(custom)
@@ -202,13 +1127,51 @@ class BStrapVars(object):
         if overrides:
             bstrap_vars.override_values = overrides
 
-        bstrap_vars.detect_types()
+        if eager:
+            bstrap_vars.detect_types()
+
         return bstrap_vars
 
     @classmethod
-    def factory_from_sass_file(cls, filename):
+    def _parse_base(cls, base):
+        # builds a BaseVars from the serialized storage form of the base
+        # variables
+        base_vars = BaseVars()
+
+        sections = base.get('sections', {})
+        for name, section_enc in sections.items():
+            info = section_enc.get('info', '')
+            section = base_vars.add_section(name, info)
+            components = section_enc.get('components', {})
+            for comp_name, comp in components.items():
+                info = comp.get('info', '')
+                section.add_component(comp_name, comp['value'], info)
+
+        nonsections = base.get('nonsections', {})
+        for name, comp in nonsections.items():
+            info = comp.get('info', '')
+            base_vars.add_component(name, comp['value'], info)
+
+        if 'colours' in base:
+            base_vars.colours = base['colours']
+
+        return base_vars
+
+    def share_base(self):
+        """Returns a new BStrapVars that shares the sections and components
+        of this one but has no custom or override values.  The base of this
+        object is frozen as a result.
+        """
+        return BStrapVars(self.base.freeze())
+
+    @classmethod
+    def factory_from_sass_file(cls, filename, eager=False):
         """A factory for BStrapVars that uses a Bootstrap SASS definition file
         to construct the information.
+
+        :param filename: name of the Bootstrap variables file to parse
+        :param eager: detect colour types immediately rather than on first
+            access of :attr:`colour_values`.  Defaults to False.
         """
         bsvars = BStrapVars()
 
@@ -251,11 +1214,19 @@ class BStrapVars(object):
                     next_info = ''
 
         # file parsed, process found data for more info
-        bsvars.detect_types()
+        if eager:
+            bsvars.detect_types()
+
         return bsvars
 
-    def base_to_json(self):
-        """Serializes the base value variables into JSON."""
+    def base_to_json(self, colours=False):
+        """Serializes the base value variables into JSON.
+
+        :param colours: when True the detected colour values are stored
+            alongside the sections so that loading the result does not
+            require the sass compiler.  Only meaningful on an object without
+            custom or override values.  Defaults to False.
+        """
         d = OrderedDict()
         if self.sections:
             d['sections'] = OrderedDict()
@@ -269,6 +1240,9 @@ class BStrapVars(object):
             for comp in self.nonsections.values():
                 d['nonsections'][comp.name] = comp.to_dict()
 
+        if colours:
+            d['colours'] = self.colour_values
+
         return json.dumps(d)
 
     def custom_to_json(self):
@@ -286,9 +1260,7 @@ class BStrapVars(object):
         :param info: [optional] info blurb about the section, defaults to
             empty
         """
-        section = Section(self, name, info)
-        self.sections[name] = section
-        return section
+        return self.base.add_section(name, info)
 
     def add_component(self, name, value, info=''):
         """Creates a new Component that is not associated with a Section and
@@ -299,10 +1271,7 @@ class BStrapVars(object):
         :param info: [optional] info blurb about the component, defaults to
             empty
         """
-        component = Component(name, value, info)
-        self.nonsections[name] = component
-        self.all_components[name] = component
-        return component
+        return self.base.add_component(name, value, info)
 
     def get_value(self, name):
         if name in self.override_values:
@@ -345,38 +1314,191 @@ class BStrapVars(object):
 
         :param name: name of component to check dependencies against
         """
-        deps = set([])
-        check_against = set([name])
-        for comp_name, value in self.all_value_pairs():
-            new_deps = set([])
-            for check_name in check_against:
-                if ('$' + check_name) in value:
-                    new_deps.add(comp_name)
-                    deps.add(comp_name)
+        return set(self.graph.all_dependents(name))
+
+    @property
+    def graph(self):
+        """:class:`DependencyGraph` of the components based on their current
+        values.  The graph is built on first access by patching the graph of
+        the base with the custom and overridden values."""
+        if self._graph is None:
+            changes = OrderedDict()
+            for name in list(self.custom_values) + list(self.override_values):
+                if name in self.all_components:
+                    value = self.get_value(name)
+                    if value != self.all_components[name].value:
+                        changes[name] = value
+
+            if changes:
+                self._graph = self.base.graph.patched(changes)
+            else:
+                self._graph = self.base.graph
 
-            check_against.update(new_deps)
+        return self._graph
 
-        return deps
+    @property
+    def colour_values(self):
+        """OrderedDict of component names mapped to their evaluated value for
+        those components that are colours.  The values are detected on first
+        access, changes to the custom or override values after that are not
+        reflected unless :func:`BStrapVars.detect_types` is called again."""
+        if self._colour_values is None:
+            self.detect_types()
+
+        return self._colour_values
+
+    @colour_values.setter
+    def colour_values(self, value):
+        self._colour_values = value
 
     def detect_types(self):
-        # uses the sass compiler to create fake CSS classes in order to
-        # evaluate the expressions in each value (whether in the component or
-        # overridden), detects those that are colours and puts the detected
-        # value in the component
+        """Populates :attr:`colour_values` with the evaluated value of every
+        component that is a colour.  When the base was loaded with stored
+        colours only the custom and overridden components and those dependent
+        on them are evaluated, everything else comes from the stored values.
+        """
+        if self.base_colours is None:
+            self.colour_values = self._evaluate_colours()
+            return
+
+        changed = list(self.custom_values) + list(self.override_values)
+        self.colour_values = self.update_colours(self.base_colours, changed)
+
+    def update_colours(self, previous, changed):
+        """Incrementally evaluates colour values.  Starting from a previously
+        resolved set of colours, only the changed components and those
+        dependent on them are evaluated and only the declarations they need
+        are sent to the sass compiler.
+
+        :param previous: dict of component names to colour values that were
+            resolved before the change, for example the stored colours of a
+            :class:`Version` or the :attr:`colour_values` of another
+            BStrapVars
+        :param changed: iterable of the names of the components whose values
+            have changed since ``previous`` was resolved, names that aren't
+            components are ignored
+        :returns: OrderedDict of names to colour values in component order
+        """
+        affected = set([])
+        for name in changed:
+            if name in self.all_components:
+                affected.add(name)
+                affected.update(self.graph.all_dependents(name))
+
+        found = {}
+        if affected:
+            found = self._evaluate_colours(affected)
+
+        colour_values = OrderedDict()
+        for name in self.all_components.keys():
+            if name in affected:
+                colours = found
+            else:
+                colours = previous
+
+            if name in colours:
+                colour_values[name] = colours[name]
+
+        return colour_values
+
+    def _needed(self, names):
+        # returns the set of components required to evaluate the given
+        # names, or None if all of them are
+        if names is None:
+            return None
+
+        needed = set(names)
+        for name in names:
+            needed.update(self.graph.all_references(name))
+
+        return needed
+
+    def _evaluate_colours(self, names=None):
+        # evaluates the expressions in each value (whether in the component or
+        # overridden) and returns those that are colours; if "names" is given
+        # only those components and the declarations they reference are
+        # evaluated.  Expressions are resolved in python when possible, the
+        # rest are handed to the sass compiler
+        needed = self._needed(names)
+        evaluator = ColourEvaluator()
+        found = {}
+        fallback = set([])
+
+        for name, value in self.all_value_pairs():
+            if needed is not None and name not in needed:
+                continue
+
+            wanted = names is None or name in names
+            try:
+                result = evaluator.define(name, value)
+            except Unsupported:
+                if wanted:
+                    fallback.add(name)
+                continue
+
+            if wanted and isinstance(result, Colour):
+                value = result.to_css()
+                if is_colour(value):
+                    found[name] = value
+
+        if fallback:
+            found.update(self._compile_colours(fallback))
+
+        colours = OrderedDict()
+        for name in self.all_components.keys():
+            if name in found:
+                colours[name] = found[name]
+
+        return colours
+
+    def _compile_colours(self, names=None):
+        # uses the sass compiler to evaluate the expressions in each value,
+        # returns those that are colours
+        colours = OrderedDict()
+        for name, value in self._compile_values(names).items():
+            if isinstance(value, Colour):
+                text = value.to_css()
+            elif isinstance(value, Text) and isinstance(value.value,
+                    string_types):
+                # strings that are colours, e.g. unquote("#fff")
+                text = value.value
+            else:
+                continue
+
+            if is_colour(text):
+                colours[name] = text
+
+        return colours
+
+    def _compile_values(self, names=None):
+        # uses the sass compiler to evaluate the expressions in each value,
+        # every evaluated value is handed to a custom function which captures
+        # it along with the text the compiler outputs for it.  If "names" is
+        # given only those components and the declarations they reference
+        # are compiled
+        needed = self._needed(names)
+
         src = ['$bootstrap-sass-asset-helper:false;']
         for name, value in self.all_value_pairs():
+            if needed is not None and name not in needed:
+                continue
+
             src.append('$%s:%s;' % (name, value))
-            src.append('.%s{color:%s}' % (name, value))
+            if names is None or name in names:
+                src.append(('$bseditor-captured:bseditor-capture("%s", $%s, '
+                    '"#{$%s}");') % (name, name, name))
 
         #with open('last_compile.txt', 'w') as f:
         #    f.write('\n'.join(src))
 
-        result = sass.compile(string='\n'.join(src))
-        for match in self.css_pieces.finditer(result):
-            name = match.group(1)
-            value = match.group(2).strip()
-            if is_colour(value):
-                self.colour_values[name] = value
+        values = OrderedDict()
+        def capture(name, value, text):
+            values[name] = from_sass_value(value, text)
+            return None
+
+        sass.compile(string='\n'.join(src),
+            custom_functions={'bseditor-capture':capture})
+        return values
 
 # ============================================================================
 # Parser
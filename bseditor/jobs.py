@@ -0,0 +1,93 @@
+# bseditor.jobs.py
+import logging, threading
+
+from django.conf import settings
+from django.db import connections
+
+from six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# Background Executor
+# ============================================================================
+#
+# Deploys run in background threads so that saving a Sheet doesn't wait for
+# the compile, the file write and the static collection.  No broker is
+# needed, jobs are lost if the process exits before they run.  The number of
+# threads is set with BSEDITOR_DEPLOY_THREADS, 0 runs jobs in the calling
+# thread.
+
+DEFAULT_THREADS = 1
+
+
+class JobExecutor(object):
+    """Runs callables on a fixed number of daemon threads, started when the
+    first job is submitted.
+
+    :param threads: number of threads to run jobs on
+    """
+    def __init__(self, threads=DEFAULT_THREADS):
+        self.threads = threads
+        self._queue = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        with self._lock:
+            if not self._workers:
+                for _ in range(self.threads):
+                    worker = threading.Thread(target=self._serve)
+                    worker.daemon = True
+                    worker.start()
+                    self._workers.append(worker)
+
+        self._queue.put((fn, args))
+
+    def join(self):
+        """Waits until every submitted job has finished."""
+        self._queue.join()
+
+    def _serve(self):
+        while True:
+            fn, args = self._queue.get()
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception('Error in background job')
+            finally:
+                # jobs use the ORM, don't leave connections open on threads
+                # that django doesn't manage
+                for connection in connections.all():
+                    connection.close()
+                self._queue.task_done()
+
+
+_executor_lock = threading.Lock()
+_executor = None
+
+def get_executor():
+    """Returns the process wide :class:`JobExecutor` or None if the
+    BSEDITOR_DEPLOY_THREADS setting is 0 and jobs should run in the calling
+    thread."""
+    global _executor
+
+    threads = getattr(settings, 'BSEDITOR_DEPLOY_THREADS', DEFAULT_THREADS)
+    if not threads:
+        return None
+
+    with _executor_lock:
+        if _executor is None or _executor.threads != threads:
+            _executor = JobExecutor(threads)
+
+        return _executor
+
+
+def submit(fn, *args):
+    """Runs ``fn(*args)`` in the background, or straight away if background
+    jobs are turned off."""
+    executor = get_executor()
+    if executor is None:
+        fn(*args)
+    else:
+        executor.submit(fn, *args)
@@ -0,0 +1,115 @@
+# bseditor.managment.commands.deploysheets.py
+#
+# Deploys all or some of the Sheet objects, compiling them in parallel
+from __future__ import print_function
+import multiprocessing, os, time
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from bseditor.models import Sheet, collect_sheets
+from bseditor.pool import CompilePool
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('sheets', nargs='*', help=('IDs or names of the '
+            'Sheets to deploy, defaults to all of them'))
+        parser.add_argument('--version-name', help=('Only deploy Sheets '
+            'based on the Version with this name'))
+        parser.add_argument('--processes', type=int,
+            default=multiprocessing.cpu_count(), help=('Number of compiler '
+            'processes, defaults to the number of CPUs'))
+        parser.add_argument('--timeout', type=int, default=60, help=(
+            'Seconds a single compile may take'))
+        parser.add_argument('--force', action='store_true', default=False,
+            help=('Deploy Sheets even if their compile inputs have not '
+            'changed since the last deploy'))
+
+    def handle(self, *args, **options):
+        start = time.time()
+
+        sheets = Sheet.objects.select_related('version').order_by('id')
+        if options['sheets']:
+            query = Q(name__in=options['sheets'])
+            ids = [s for s in options['sheets'] if s.isdigit()]
+            if ids:
+                query |= Q(id__in=ids)
+
+            sheets = sheets.filter(query)
+
+        if options['version_name']:
+            sheets = sheets.filter(version__name=options['version_name'])
+
+        # work out what needs compiling, the database is only used from
+        # this thread
+        jobs = []
+        skipped = 0
+        for sheet in sheets:
+            digest, compile = sheet.compiler()
+            if not options['force'] and digest == sheet.deploy_digest \
+                    and os.path.exists(sheet.full_filename):
+                skipped += 1
+                continue
+
+            jobs.append((sheet, digest, compile))
+
+        processes = max(options['processes'], 1)
+        pool = None
+        if processes > 1 and len(jobs) > 1:
+            pool = CompilePool(processes=processes,
+                timeout=options['timeout'], max_queue=len(jobs))
+
+        def run(job):
+            job_start = time.time()
+            try:
+                css = job[2](pool=pool)
+                error = None
+            except Exception as e:
+                css = None
+                error = e
+
+            return job, css, error, time.time() - job_start
+
+        if pool is None:
+            results = (run(job) for job in jobs)
+        else:
+            threads = ThreadPool(processes)
+            results = threads.imap_unordered(run, jobs)
+
+        deployed = 0
+        written = []
+        failed = 0
+        compile_time = 0
+        try:
+            for (sheet, digest, _), css, error, elapsed in results:
+                compile_time += elapsed
+                if error is not None:
+                    failed += 1
+                    self.stderr.write('Failed %s: %s' % (sheet.name, error))
+                    continue
+
+                deployed += 1
+                if sheet.deploy(css, digest, collect=False, duration=elapsed):
+                    written.append(sheet)
+                    print('Deployed %s (%.2fs)' % (sheet.filename, elapsed))
+                else:
+                    print('Deployed %s, output unchanged (%.2fs)' % (
+                        sheet.filename, elapsed))
+        finally:
+            if pool is not None:
+                threads.close()
+                pool.close()
+
+        # static collection happens once rather than per sheet and only for
+        # files that changed
+        collect_start = time.time()
+        collect_sheets(written)
+        collect_time = time.time() - collect_start
+
+        print(('Deployed %s (%s written), skipped %s unchanged, %s failed in '
+            '%.2fs (compile %.2fs, collect %.2fs)') % (deployed, len(written),
+            skipped, failed, time.time() - start, compile_time, collect_time))
+
+        if failed:
+            raise CommandError('%s sheets failed to deploy' % failed)
@@ -1,20 +1,45 @@
 # bseditor.models.py
-import logging, os
+import hashlib, logging, os, time
+from datetime import timedelta
 
 from django.conf import settings
 from django.core.management import call_command
 from django.db import models
+from django.db.models import F, Q
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.text import slugify
 
 import sass
 from awl.absmodels import TimeTrackModel
-from wrench.utils import When, dynamic_load
+from six import text_type
+from wrench.utils import dynamic_load
 
+from .cache import (_compile, atomic_write, compile_key, compile_sass,
+    get_store)
 from .conv import BStrapVars
+from .jobs import submit
+from .sources import (SourceRecord, bundled_source, chain_source,
+    file_digest)
+from .splice import SpliceTemplate, cached_template
 
 logger = logging.getLogger(__name__)
 
+# compile filename mapped to the time its fingerprint was last checked and
+# the result, see BSEDITOR_SOURCE_CHECK_INTERVAL
+_checked_fingerprints = {}
+
+
+def variables_source(bsv):
+    """Returns the Sass variable declarations for a :class:`BStrapVars`,
+    these go in front of the compile file."""
+    src = ['$bootstrap-sass-asset-helper:false;']
+    for name, value in bsv.all_value_pairs():
+        src.append('$%s:%s;' % (name, value))
+
+    return '\n'.join(src)
+
+
 # ============================================================================
 # Models
 # ============================================================================
@@ -34,11 +59,15 @@ class Version(TimeTrackModel):
     :param variables_filename: fully qualified path to a file to parse to 
         construct the base set of variables that can be customized.  This
         normally points to one of Bootstrap's _variables.scss files.
+    :param fingerprint: result of the last :func:`Version.source_fingerprint`
+        that re-scanned the sources
     """
     name = models.CharField(max_length=50, unique=True)
     compile_filename = models.TextField()
     variables_filename = models.TextField()
     _store = models.TextField()
+    _sources = models.TextField(blank=True)
+    fingerprint = models.CharField(max_length=40, blank=True)
 
     @classmethod
     def factory(cls, name, variables_filename, compile_filename):
@@ -52,11 +81,19 @@ class Version(TimeTrackModel):
         ]
         sass.compile(string='\n'.join(src))
 
-        # get JSON version of variables file to store using BSV
+        # get JSON version of variables file to store using BSV, the
+        # evaluated colours are stored as well so loading never needs to
+        # compile unless there are customizations
         bsv = BStrapVars.factory_from_sass_file(variables_filename)
 
+        # record the import chain of the compile file so changes to any of
+        # the files it uses can be detected
+        record = SourceRecord.scan(compile_filename)
+
         v = Version.objects.create(name=name, compile_filename=compile_filename,
-            variables_filename=variables_filename, _store=bsv.base_to_json())
+            variables_filename=variables_filename,
+            _store=bsv.base_to_json(colours=True), _sources=record.to_json(),
+            fingerprint=record.fingerprint)
         return v
 
     def __str__(self):
@@ -68,6 +105,106 @@ class Version(TimeTrackModel):
         """
         return BStrapVars.factory(self._store)
 
+    def source_fingerprint(self):
+        """Returns a string that changes whenever the contents of
+        :attr:`compile_filename` or any of the files in its import chain
+        change.  The recorded files are checked with stat calls, only if
+        one of them has been touched is the import chain re-scanned and the
+        record updated.
+        """
+        # optionally trust a recent check to avoid stat calls, useful when
+        # the sources are on a network mount and rarely change
+        interval = getattr(settings, 'BSEDITOR_SOURCE_CHECK_INTERVAL', 0)
+        if interval:
+            checked = _checked_fingerprints.get(self.compile_filename)
+            if checked and time.time() - checked[0] < interval:
+                self.fingerprint = checked[1]
+                return checked[1]
+
+        record = None
+        if self._sources:
+            record = SourceRecord.from_json(self._sources)
+
+        if record is None or record.filename != self.compile_filename \
+                or not record.is_current():
+            record = SourceRecord.scan(self.compile_filename)
+            self._sources = record.to_json()
+            self.fingerprint = record.fingerprint
+            if self.id:
+                # avoid save() so the modification time isn't changed
+                Version.objects.filter(id=self.id).update(
+                    _sources=self._sources, fingerprint=self.fingerprint)
+
+        fingerprint = record.fingerprint
+        self.fingerprint = fingerprint
+        if interval:
+            _checked_fingerprints[self.compile_filename] = (time.time(),
+                fingerprint)
+
+        return fingerprint
+
+    def bundled_source(self, fingerprint=None):
+        """Returns :attr:`compile_filename` with all of its imports expanded
+        into a single piece of SCSS.  The files are read once per
+        :func:`Version.source_fingerprint` and kept in memory, compiling the
+        result needs no file access.  Returns None if bundling is turned off
+        with the BSEDITOR_BUNDLE_SOURCES setting or isn't possible for these
+        sources.
+
+        :param fingerprint: result of :func:`Version.source_fingerprint` if
+            the caller already has it
+        """
+        if not getattr(settings, 'BSEDITOR_BUNDLE_SOURCES', True):
+            return None
+
+        if fingerprint is None:
+            fingerprint = self.source_fingerprint()
+
+        return bundled_source(self.compile_filename, fingerprint)
+
+    def splice_template(self, fingerprint=None):
+        """Returns the :class:`bseditor.splice.SpliceTemplate` used to
+        produce CSS for colour changes without compiling.  Templates are
+        built once per :func:`Version.source_fingerprint`, which takes a
+        few dozen compiles, and kept in memory and in the compiled CSS
+        store.  The build runs as a background job on the compile pool (see
+        bseditor.jobs and bseditor.pool), until it has finished None is
+        returned and sheets are compiled as usual.  Returns None if splicing
+        isn't turned on with the BSEDITOR_SPLICE_ENGINE setting or a
+        template couldn't be built.
+
+        :param fingerprint: result of :func:`Version.source_fingerprint` if
+            the caller already has it
+        """
+        if not getattr(settings, 'BSEDITOR_SPLICE_ENGINE', False):
+            return None
+
+        if fingerprint is None:
+            fingerprint = self.source_fingerprint()
+
+        bundle = self.bundled_source(fingerprint)
+
+        def compile_values(values):
+            bsv = BStrapVars.factory(self._store, overrides=values)
+            variables = variables_source(bsv)
+            if bundle is None:
+                return _compile('%s\n@import "%s";' % (variables,
+                    self.compile_filename), None, None)
+
+            return _compile('%s\n%s' % (variables, bundle), None, None)
+
+        def build():
+            # without a bundle the files on disk are scanned instead
+            source = bundle
+            if source is None:
+                source = chain_source(self.compile_filename)
+
+            return SpliceTemplate.build(compile_values, self.get_vars(),
+                source)
+
+        key = 'splice-' + compile_key(self._store, fingerprint)
+        return cached_template(key, build, get_store(), background=True)
+
 
 @python_2_unicode_compatible
 class Sheet(TimeTrackModel):
@@ -75,11 +212,29 @@ class Sheet(TimeTrackModel):
 
     :param name: human readable name for this customizable style sheet
     :param version: :class:`Version` object this `Sheet` is based upon
+    :param deployed: time of the last deploy
+    :param deploy_digest: digest of the compile inputs when the sheet was
+        last deployed, see :func:`Sheet.compiler`
+    :param deploy_fingerprint: :attr:`Version.fingerprint` when the sheet
+        was last deployed
+    :param output_digest: SHA1 of the deployed CSS
+    :param output_size: size of the deployed CSS in bytes
+    :param compile_duration: seconds the last deploy spent compiling
     """
     name = models.CharField(max_length=50, unique=True)
     version = models.ForeignKey(Version)
     _store = models.TextField(blank=True)
 
+    deployed = models.DateTimeField(null=True, blank=True)
+    deploy_digest = models.CharField(max_length=40, blank=True)
+    deploy_fingerprint = models.CharField(max_length=40, blank=True)
+    output_digest = models.CharField(max_length=40, blank=True)
+    output_size = models.IntegerField(null=True, blank=True)
+    compile_duration = models.FloatField(null=True, blank=True)
+
+    DEPLOY_FIELDS = ('deployed', 'deploy_digest', 'deploy_fingerprint',
+        'output_digest', 'output_size', 'compile_duration')
+
     @classmethod
     def factory(cls, name, version, custom=None):
         if not custom:
@@ -117,45 +272,250 @@ class Sheet(TimeTrackModel):
 
     @property
     def last_deploy(self):
+        return self.deployed
+
+    @classmethod
+    def out_of_date_query(cls):
+        """Returns a ``Q`` object matching sheets that have never been
+        deployed, were edited after their last deploy or whose Version
+        sources have changed since."""
+        return Q(deployed__isnull=True) | Q(updated__gt=F('deployed')) \
+            | ~Q(deploy_fingerprint=F('version__fingerprint'))
+
+    def sass_source(self, overrides=None):
+        """Returns the Sass source that is compiled to create the CSS for
+        this sheet.
+
+        :param overrides: optional override values, see
+            :func:`BStrapVars.factory`
+        """
+        return '%s\n@import "%s";' % (
+            variables_source(self.get_vars(overrides)),
+            self.version.compile_filename)
+
+    def compiler(self, overrides=None):
+        """Does the database and file work needed to compile this sheet.
+        Returns a tuple of a digest of the compile inputs (see
+        :func:`bseditor.cache.compile_key`) and a callable that returns the
+        CSS.  The callable is safe to run on another thread, it takes an
+        optional ``pool`` keyword to compile in a specific
+        :class:`bseditor.pool.CompilePool`.
+
+        :param overrides: optional override values, see
+            :func:`BStrapVars.factory`
+        """
+        bsv = self.get_vars(overrides)
+        variables = variables_source(bsv)
+        src = '%s\n@import "%s";' % (variables, self.version.compile_filename)
+
+        # identical sources are only compiled once, see bseditor.cache, and
+        # when compiled the in-memory bundle is used instead of the files
+        fingerprint = self.version.source_fingerprint()
+        compile_source = None
+        bundle = self.version.bundled_source(fingerprint)
+        if bundle is not None:
+            compile_source = '%s\n%s' % (variables, bundle)
+
+        # colour changes can be spliced into a template instead of being
+        # compiled, see bseditor.splice
+        def splice():
+            template = self.version.splice_template(fingerprint)
+            if template is not None:
+                return template.render_vars(bsv)
+
+        def compile(pool=None):
+            if getattr(settings, 'BSEDITOR_TRACK_LAST_COMPILE', False):
+                filename = os.path.abspath(os.path.join(
+                    settings.BSEDITOR_DEPLOY_DIR, "last_compile.txt"))
+                with open(filename, 'w') as f:
+                    f.write(src)
+
+            return compile_sass(src, fingerprint, compile_source, splice,
+                pool=pool)
+
+        return compile_key(src, fingerprint), compile
+
+    def compiled_string(self, overrides=None):
+        _, compile = self.compiler(overrides)
+        return compile()
+
+    def _file_matches(self, output_digest):
+        # True if full_filename already holds CSS with the given digest, uses
+        # the recorded digest and a stat call where possible
         try:
-            last_modified = os.path.getmtime(self.full_filename)
-            return When(epoch=last_modified).datetime
+            size = os.path.getsize(self.full_filename)
         except OSError:
-            return None
+            return False
+
+        if self.output_digest:
+            return self.output_digest == output_digest \
+                and self.output_size == size
+
+        return file_digest(self.full_filename) == output_digest
+
+    def deploy(self, css=None, digest=None, collect=True, duration=None):
+        """Writes the compiled CSS to :attr:`full_filename`, records the
+        deploy and runs the static collection configured for deploys.  If
+        the file already holds the same CSS it is left alone and nothing is
+        collected.  The file is replaced atomically so the web server never
+        sees a partial write.  Returns True if the file was written.
+
+        :param css: optional CSS to write instead of compiling, must be
+            given along with its ``digest``
+        :param digest: digest of the compile inputs, see
+            :func:`Sheet.compiler`
+        :param collect: False to skip static collection, see
+            :func:`collect_sheets`
+        :param duration: seconds spent compiling ``css``
+        """
+        if css is None:
+            start = time.time()
+            digest, compile = self.compiler()
+            css = compile()
+            duration = time.time() - start
+
+        content = css
+        if isinstance(content, text_type):
+            content = content.encode('utf-8')
+
+        output_digest = hashlib.sha1(content).hexdigest()
+        changed = not self._file_matches(output_digest)
+        if changed:
+            # the deploy directory is collected as static files, a failed
+            # write mustn't leave a temporary file behind
+            atomic_write(self.full_filename, content, 0o644)
+
+        self.deployed = timezone.now()
+        self.deploy_digest = digest
+        self.deploy_fingerprint = self.version.fingerprint
+        self.output_digest = output_digest
+        self.output_size = len(content)
+        self.compile_duration = duration
+
+        # avoid save() so the edit time isn't changed
+        Sheet.objects.filter(id=self.id).update(**dict(
+            (name, getattr(self, name)) for name in self.DEPLOY_FIELDS))
+
+        if changed and collect:
+            collect_sheets([self])
+
+        return changed
+
+
+def collect_sheets(sheets):
+    """Runs the static collection configured for deploys once for a group of
+    deployed sheets.  The BSEDITOR_COLLECT_HOOK is called for each of them,
+    collectstatic only runs once.
+
+    :param sheets: list of :class:`Sheet` objects that were deployed
+    """
+    if not sheets or not getattr(settings, 'BSEDITOR_COLLECT_ON_DEPLOY',
+            False):
+        return
+
+    # handle static collection on deployment
+    hook = getattr(settings, 'BSEDITOR_COLLECT_HOOK', '')
+    if hook:
+        # use the defined collection hook instead of collectstatic
+        fn = dynamic_load(hook)
+        for sheet in sheets:
+            fn(sheet)
+    else:
+        # use default collectstatic during deploy
+        call_command('collectstatic', '--noinput')
 
-    def compiled_string(self, overrides=None):
-        bsv = self.get_vars(overrides)
 
-        src = ['$bootstrap-sass-asset-helper:false;']
-        for name, value in bsv.all_value_pairs():
-            src.append('$%s:%s;' % (name, value))
+@python_2_unicode_compatible
+class DeployJob(TimeTrackModel):
+    """A request to deploy a :class:`Sheet`, run in the background so the
+    editor doesn't wait for the compile.  See bseditor.jobs.
+
+    :param sheet: :class:`Sheet` object to deploy
+    :param status: one of QUEUED, RUNNING, DONE or FAILED
+    :param message: error message if the deploy failed
+    :param started: time the deploy started running
+    :param finished: time the deploy finished, successfully or not
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    # seconds a job may be queued or running before it is considered lost,
+    # see the BSEDITOR_DEPLOY_TIMEOUT setting
+    DEFAULT_TIMEOUT = 300
+
+    sheet = models.ForeignKey(Sheet)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+        default=QUEUED)
+    message = models.TextField(blank=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def enqueue(cls, sheet):
+        """Creates a job for the sheet and submits it to the background
+        executor.  If background jobs are turned off the job has finished
+        by the time this returns."""
+        job = DeployJob.objects.create(sheet=sheet)
+        submit(job.run)
+        return job
+
+    @classmethod
+    def expire_lost(cls):
+        """Jobs are lost if the process running them exits.  Marks any job
+        that has been queued or running for longer than the
+        BSEDITOR_DEPLOY_TIMEOUT setting (in seconds) as failed.  Returns the
+        number of jobs changed."""
+        timeout = getattr(settings, 'BSEDITOR_DEPLOY_TIMEOUT',
+            cls.DEFAULT_TIMEOUT)
+        now = timezone.now()
+        cutoff = now - timedelta(seconds=timeout)
+
+        lost = Q(status=cls.QUEUED, created__lt=cutoff) \
+            | Q(status=cls.RUNNING, started__lt=cutoff)
+        return cls.objects.filter(lost).update(status=cls.FAILED,
+            message='Deploy did not finish within %s seconds' % timeout,
+            finished=now)
+
+    def __str__(self):
+        return 'DeployJob(id=%s sheet.id=%s status=%s)' % (self.id,
+            self.sheet_id, self.status)
 
-        src.append('@import "%s";' % self.version.compile_filename)
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
 
-        if getattr(settings, 'BSEDITOR_TRACK_LAST_COMPILE', False):
-            filename = os.path.abspath(os.path.join(
-                settings.BSEDITOR_DEPLOY_DIR, "last_compile.txt"))
-            with open(filename, 'w') as f:
-                f.write('\n'.join(src))
+    @property
+    def duration(self):
+        """Number of seconds the deploy took, None if it hasn't finished."""
+        if not self.started or not self.finished:
+            return None
 
-        return sass.compile(string='\n'.join(src))
+        return (self.finished - self.started).total_seconds()
 
-    def deploy(self):
-        result = self.compiled_string()
+    def run(self):
+        self.status = self.RUNNING
+        self.started = timezone.now()
+        self.save()
 
-        with open(self.full_filename, 'w') as f:
-            f.write(result)
+        try:
+            self.sheet.deploy()
+            self.status = self.DONE
+        except Exception as e:
+            logger.exception('Error deploying %s', self.sheet)
+            self.status = self.FAILED
+            self.message = str(e)
 
-        if getattr(settings, 'BSEDITOR_COLLECT_ON_DEPLOY', False):
-            # handle static collection on deployment
-            hook = getattr(settings, 'BSEDITOR_COLLECT_HOOK', '')
-            if hook:
-                # use the defined collection hook instead of collectstatic
-                fn = dynamic_load(hook)
-                fn(self)
-            else:
-                # use default collectstatic during deploy
-                call_command('collectstatic', '--noinput')
+        self.finished = timezone.now()
+        self.save()
 
 
 @python_2_unicode_compatible
@@ -165,9 +525,18 @@ class PreviewSheet(TimeTrackModel):
 
     :param sheet: :class:`Sheet` object that this `PreviewSheet` is built on
         top of
+    :param css: CSS compiled from the sheet and the stored values
+    :param css_digest: SHA1 of :attr:`css`, empty if it needs compiling
+    :param css_fingerprint: :attr:`Version.fingerprint` when :attr:`css` was
+        compiled
+    :param compiled: time :attr:`css` was compiled
     """
     sheet = models.ForeignKey(Sheet)
     _store = models.TextField(blank=True)
+    css = models.TextField(blank=True)
+    css_digest = models.CharField(max_length=40, blank=True)
+    css_fingerprint = models.CharField(max_length=40, blank=True)
+    compiled = models.DateTimeField(null=True, blank=True)
 
     @classmethod
     def factory(cls, sheet, overrides):
@@ -178,9 +547,42 @@ class PreviewSheet(TimeTrackModel):
     def __str__(self):
         return 'PreviewSheet(id=%s sheet.id=%s)' % (self.id, self.sheet.id)
 
-    def content(self):
+    @property
+    def is_stale(self):
+        """True if :attr:`css` is missing or older than the last change to
+        the sheet or its Version.  Only the loaded objects are compared, use
+        ``select_related('sheet__version')`` to check with a single query.
+        Changes to the Sass files are seen once :attr:`Version.fingerprint`
+        has been refreshed by :func:`Version.source_fingerprint`."""
+        sheet = self.sheet
+        return not self.css_digest or self.compiled is None \
+            or self.compiled < sheet.updated \
+            or self.compiled < sheet.version.updated \
+            or self.css_fingerprint != sheet.version.fingerprint
+
+    def compile(self):
+        """Compiles the sheet with the stored values and saves the result.
+        Nothing is saved if the compile fails."""
         overrides = None
         if self._store:
             overrides = self._store
 
-        return self.sheet.compiled_string(overrides)
+        _, compile = self.sheet.compiler(overrides)
+        self.css = compile()
+
+        # the compiler has refreshed the Version's fingerprint
+        self.css_fingerprint = self.sheet.version.fingerprint
+
+        content = self.css
+        if isinstance(content, text_type):
+            content = content.encode('utf-8')
+
+        self.css_digest = hashlib.sha1(content).hexdigest()
+        self.compiled = timezone.now()
+        self.save()
+
+    def content(self):
+        if self.is_stale:
+            self.compile()
+
+        return self.css
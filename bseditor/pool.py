@@ -0,0 +1,231 @@
+# bseditor.pool.py
+import logging, multiprocessing, threading
+
+from django.conf import settings
+
+import sass
+from six.moves import queue
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# Compiler Worker Pool
+# ============================================================================
+#
+# Compiles can be handed to a pool of long-lived worker processes so that a
+# runaway compile (e.g. an endless @while in a custom compile file) can't
+# block a web worker.  Each compile has a timeout after which its worker is
+# killed and replaced, workers can be capped in memory and are recycled
+# after a number of compiles.  The pool is configured through the
+# BSEDITOR_COMPILE_POOL setting:
+#
+#   BSEDITOR_COMPILE_POOL = {
+#       'processes':4,
+#       'timeout':30,
+#       'max_queue':16,
+#       'memory_limit':512 * 1024 * 1024,
+#       'max_jobs':100,
+#   }
+#
+# If the setting isn't present compiles run in the calling thread.
+
+class PoolError(Exception):
+    pass
+
+
+class PoolFull(PoolError):
+    pass
+
+
+class CompileTimeout(PoolError):
+    pass
+
+
+def _serve(connection, memory_limit):
+    # worker process main loop, receives Sass source and replies with a
+    # tuple of ("css", result) or ("error", message)
+    if memory_limit and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    while True:
+        try:
+            source = connection.recv()
+        except EOFError:
+            return
+
+        if source is None:
+            return
+
+        try:
+            result = ('css', sass.compile(string=source))
+        except sass.CompileError as e:
+            result = ('error', str(e))
+        except MemoryError:
+            result = ('error', 'Compile ran out of memory')
+
+        connection.send(result)
+
+
+class Worker(object):
+    """A compiler process and the pipe used to talk to it.
+
+    :param memory_limit: optional maximum address space of the process in
+        bytes
+    """
+    def __init__(self, memory_limit=None):
+        self.jobs = 0
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve,
+            args=(child, memory_limit))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+    def compile(self, source, timeout):
+        """Compiles the source in the worker process.  Raises
+        :class:`CompileTimeout` if it takes longer than ``timeout`` seconds
+        and :class:`PoolError` if the process dies, the worker is stopped in
+        both cases."""
+        self.jobs += 1
+        self.connection.send(source)
+        if not self.connection.poll(timeout):
+            logger.warning('Stopping compiler process %s after %s seconds',
+                self.process.pid, timeout)
+            self.stop()
+            raise CompileTimeout('Compile took longer than %s seconds' % (
+                timeout))
+
+        try:
+            kind, value = self.connection.recv()
+        except EOFError:
+            self.stop()
+            raise PoolError('Compiler process exited with code %s' % (
+                self.process.exitcode))
+
+        if kind == 'error':
+            raise sass.CompileError(value)
+
+        return value
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.terminate()
+
+        self.process.join()
+        self.connection.close()
+
+
+class CompilePool(object):
+    """Fixed number of compiler processes shared by the threads of a
+    process.  Workers are started when first needed.
+
+    :param processes: number of worker processes
+    :param timeout: seconds a compile may take before its worker is killed,
+        also the longest a compile waits for a free worker
+    :param max_queue: number of compiles that may wait for a free worker,
+        beyond that :class:`PoolFull` is raised straight away
+    :param memory_limit: optional maximum address space of each worker in
+        bytes, only enforced where the ``resource`` module is available
+    :param max_jobs: number of compiles after which a worker is replaced
+    """
+    def __init__(self, processes=2, timeout=30, max_queue=8,
+            memory_limit=None, max_jobs=100):
+        self.processes = processes
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.memory_limit = memory_limit
+        self.max_jobs = max_jobs
+        self.started = 0
+        self.closed = False
+
+        # idle workers, None is a slot whose worker hasn't been started
+        self._idle = queue.Queue()
+        for _ in range(processes):
+            self._idle.put(None)
+
+        self._admitted = threading.BoundedSemaphore(processes + max_queue)
+
+    def compile(self, source):
+        """Compiles Sass source in one of the workers and returns the CSS.
+        Raises ``sass.CompileError`` for problems with the source and
+        :class:`PoolError` subclasses for problems running it."""
+        if self.closed:
+            raise PoolError('Pool has been closed')
+
+        if not self._admitted.acquire(False):
+            raise PoolFull('Too many compiles waiting')
+
+        try:
+            try:
+                worker = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise PoolFull('No compiler free after %s seconds' % (
+                    self.timeout))
+
+            try:
+                if worker is None or not worker.alive:
+                    worker = Worker(self.memory_limit)
+                    self.started += 1
+
+                return worker.compile(source, self.timeout)
+            finally:
+                self._release(worker)
+        finally:
+            self._admitted.release()
+
+    def _release(self, worker):
+        if worker is not None and (self.closed or not worker.alive \
+                or worker.jobs >= self.max_jobs):
+            worker.stop()
+            worker = None
+
+        self._idle.put(worker)
+
+    def close(self):
+        """Stops the idle workers, busy ones are stopped when their compile
+        finishes."""
+        self.closed = True
+        while True:
+            try:
+                worker = self._idle.get(False)
+            except queue.Empty:
+                return
+
+            if worker is not None:
+                worker.stop()
+
+
+_pool_lock = threading.Lock()
+_pool = None
+_pool_config = None
+
+def get_pool():
+    """Returns the pool configured by the BSEDITOR_COMPILE_POOL setting or
+    None if compiles run in the calling thread.  The pool is created on
+    first use and replaced if the setting changes."""
+    global _pool, _pool_config
+
+    config = getattr(settings, 'BSEDITOR_COMPILE_POOL', None)
+    with _pool_lock:
+        if _pool_config != config:
+            if _pool is not None:
+                _pool.close()
+
+            _pool = None
+            if config:
+                _pool = CompilePool(**config)
+
+            _pool_config = config
+
+        return _pool
+
@@ -0,0 +1,333 @@
+# bseditor.sources.py
+import hashlib, io, json, logging, os, re
+from collections import OrderedDict
+
+from .conv import BaseCache
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# Sass Import Graph
+# ============================================================================
+#
+# A compile file pulls in the rest of Bootstrap through a chain of @import
+# statements.  The functions here discover every file in that chain so that
+# anything built from a compile (e.g. cached CSS) can be invalidated when
+# one of the files changes on disk.
+
+SASS_EXTENSIONS = ('.scss', '.sass')
+
+BLOCK_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+LINE_COMMENT = re.compile(r'(^|\s)//.*$', re.MULTILINE)
+
+# the body of an @import up to the end of the statement, SCSS statements end
+# with a semicolon, indented syntax ones with the end of the line
+IMPORT = re.compile(r'@import\s+([^;\n]+)')
+IMPORT_ITEM = re.compile(r'''"([^"]*)"|'([^']*)'|([^\s,'"]+)''')
+
+
+def _is_css_import(name):
+    # imports that libsass leaves alone as plain CSS imports
+    return not name or name.startswith('url(') or '://' in name \
+        or name.endswith('.css')
+
+
+def import_names(content):
+    """Returns a list of the names found in the @import statements of a
+    piece of Sass, in either syntax.  Imports that libsass leaves as plain
+    CSS imports (urls, remote files and .css files) are not included.
+
+    :param content: string containing the Sass to parse
+    """
+    content = BLOCK_COMMENT.sub('', content)
+    content = LINE_COMMENT.sub('', content)
+
+    names = []
+    for statement in IMPORT.findall(content):
+        for match in IMPORT_ITEM.finditer(statement):
+            name = match.group(1) or match.group(2) or match.group(3)
+            if _is_css_import(name):
+                continue
+
+            names.append(name)
+
+    return names
+
+
+def resolve_import(name, directory):
+    """Finds the file an @import refers to following the Sass partial rules:
+    "foo/bar" can be "foo/bar.scss", "foo/_bar.scss" or the ".sass"
+    equivalents.  Returns the absolute filename or None if no file is found.
+
+    :param name: name used in the @import statement
+    :param directory: directory of the file containing the statement
+    """
+    path = os.path.join(directory, name)
+    head, tail = os.path.split(path)
+
+    candidates = []
+    if tail.endswith(SASS_EXTENSIONS):
+        candidates.append(path)
+        candidates.append(os.path.join(head, '_' + tail))
+    else:
+        for extension in SASS_EXTENSIONS:
+            candidates.append(path + extension)
+            candidates.append(os.path.join(head, '_' + tail + extension))
+
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return os.path.abspath(candidate)
+
+    return None
+
+
+def import_graph(filename, contents=None):
+    """Walks the @import chain starting at the given file.  Returns an
+    OrderedDict mapping each absolute filename found to the list of
+    filenames it imports, in the order they were discovered.  Imports that
+    can't be resolved are skipped, libsass reports those when compiling.
+
+    :param filename: Sass file to start from
+    :param contents: optional dict that is populated with the contents of
+        each file found
+    """
+    graph = OrderedDict()
+    pending = [os.path.abspath(filename)]
+    while pending:
+        current = pending.pop(0)
+        if current in graph:
+            continue
+
+        with io.open(current, encoding='utf-8', errors='replace') as f:
+            content = f.read()
+
+        if contents is not None:
+            contents[current] = content
+
+        directory = os.path.dirname(current)
+        imports = []
+        for name in import_names(content):
+            found = resolve_import(name, directory)
+            if found is not None and found not in imports:
+                imports.append(found)
+
+        graph[current] = imports
+        pending.extend(imports)
+
+    return graph
+
+
+def file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+class SourceRecord(object):
+    """The state of every file in the import chain of a compile file.  Each
+    file is stored with its size, modification time and a digest of its
+    contents.  The fingerprint is calculated from the content digests so
+    touching a file without changing it doesn't change the fingerprint.
+
+    :param filename: compile file the import chain starts from
+    :param files: OrderedDict of filenames mapped to dictionaries with
+        "size", "mtime", "sha1" and "imports" keys
+    """
+    def __init__(self, filename, files):
+        self.filename = filename
+        self.files = files
+
+    @classmethod
+    def scan(cls, filename):
+        """Builds a SourceRecord by walking the import graph of a file and
+        hashing everything found."""
+        files = OrderedDict()
+        for name, imports in import_graph(filename).items():
+            stat = os.stat(name)
+            files[name] = OrderedDict([
+                ('size', stat.st_size),
+                ('mtime', stat.st_mtime),
+                ('sha1', file_digest(name)),
+                ('imports', imports),
+            ])
+
+        return SourceRecord(os.path.abspath(filename), files)
+
+    @classmethod
+    def from_json(cls, content):
+        d = json.loads(content, object_pairs_hook=OrderedDict)
+        return SourceRecord(d['filename'], d['files'])
+
+    def to_json(self):
+        return json.dumps(OrderedDict([
+            ('filename', self.filename),
+            ('files', self.files),
+        ]))
+
+    @property
+    def fingerprint(self):
+        digest = hashlib.sha1()
+        for name, info in self.files.items():
+            digest.update(('%s:%s\n' % (name, info['sha1'])).encode('utf-8'))
+
+        return digest.hexdigest()
+
+    def is_current(self):
+        """Returns True if every recorded file still has the same size and
+        modification time, only uses stat calls."""
+        for name, info in self.files.items():
+            try:
+                stat = os.stat(name)
+            except OSError:
+                return False
+
+            if stat.st_size != info['size'] or stat.st_mtime != info['mtime']:
+                return False
+
+        return True
+
+# ============================================================================
+# Source Bundles
+# ============================================================================
+
+class Unbundleable(Exception):
+    pass
+
+
+# SCSS pieces that matter when expanding imports: comments are kept as is,
+# import statements are replaced
+SCSS_PIECES = re.compile(r'(/\*.*?\*/)|(//[^\n]*)|@import\s+([^;\n]+);?',
+    re.DOTALL)
+
+
+class SourceBundle(object):
+    """In-memory copy of every file in the import chain of a compile file.
+    :func:`SourceBundle.flatten` expands the @import statements into a
+    single piece of SCSS, compiling that string needs no access to the
+    files on disk.
+
+    Files in the indented syntax can only be bundled if they contain no
+    nested blocks, which is the case for a typical compile file that sets a
+    few variables and imports Bootstrap.
+
+    :param filename: compile file the import chain starts from
+    """
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.contents = {}
+        self.graph = import_graph(self.filename, self.contents)
+
+    def flatten(self):
+        """Returns the SCSS for the compile file with all of its imports
+        expanded.  Raises :class:`Unbundleable` if any part of the chain
+        can't be expanded."""
+        return self._expand(self.filename, 0)
+
+    def _expand(self, filename, depth):
+        if depth > 50:
+            raise Unbundleable('import chain too deep at %s' % filename)
+
+        content = self.contents[filename]
+        if filename.endswith('.sass'):
+            content = self._indented_to_scss(filename, content)
+
+        directory = os.path.dirname(filename)
+
+        def replace(match):
+            if match.group(3) is None:
+                # comment
+                return match.group(0)
+
+            pieces = []
+            for item in IMPORT_ITEM.finditer(match.group(3)):
+                name = item.group(1) or item.group(2) or item.group(3)
+                if _is_css_import(name):
+                    pieces.append('@import %s;' % item.group(0))
+                    continue
+
+                found = resolve_import(name, directory)
+                if found is None or found not in self.contents:
+                    raise Unbundleable('cannot resolve import %s in %s' % (
+                        name, filename))
+
+                pieces.append(self._expand(found, depth + 1))
+
+            return '\n'.join(pieces)
+
+        return SCSS_PIECES.sub(replace, content)
+
+    def _indented_to_scss(self, filename, content):
+        lines = []
+        for line in content.splitlines():
+            stripped = line.strip()
+            if not stripped or stripped.startswith('//'):
+                continue
+
+            if line[0].isspace() or stripped[0] in '=+' \
+                    or stripped.startswith('/*'):
+                raise Unbundleable('nested indented syntax in %s' % filename)
+
+            if not stripped.endswith(';'):
+                stripped += ';'
+
+            lines.append(stripped)
+
+        return '\n'.join(lines)
+
+
+# flattened sources keyed by compile filename and fingerprint, an empty
+# string marks a chain that can't be bundled
+bundle_cache = BaseCache(size=8)
+
+def bundled_source(filename, fingerprint):
+    """Returns the flattened SCSS for a compile file, the files are only read
+    the first time a fingerprint is seen.  Returns None if the import chain
+    can't be bundled.
+
+    :param filename: compile file the import chain starts from
+    :param fingerprint: fingerprint of the chain, see
+        :attr:`SourceRecord.fingerprint`
+    """
+    key = (filename, fingerprint)
+    result = bundle_cache.get(key)
+    if result is None:
+        try:
+            result = SourceBundle(filename).flatten()
+        except Unbundleable as e:
+            logger.info('Compiling %s from disk: %s', filename, e)
+            result = ''
+
+        bundle_cache.put(key, result)
+
+    return result or None
+
+
+def chain_source(filename):
+    """Returns the content of every file in the import chain of a compile
+    file joined together, for scanning rather than compiling.  Indented
+    syntax lines are terminated with a semicolon so that they read as
+    statements.  Returns None if any import in the chain can't be resolved
+    as the scan would then be incomplete.
+
+    :param filename: compile file the import chain starts from
+    """
+    contents = {}
+    graph = import_graph(filename, contents)
+
+    pieces = []
+    for name in graph:
+        content = contents[name]
+        directory = os.path.dirname(name)
+        for imported in import_names(content):
+            if resolve_import(imported, directory) is None:
+                return None
+
+        if name.endswith('.sass'):
+            content = '\n'.join(line.strip().rstrip(';') + ';'
+                for line in content.splitlines() if line.strip())
+
+        pieces.append(content)
+
+    return '\n'.join(pieces)
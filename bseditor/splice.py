@@ -0,0 +1,351 @@
+# bseditor.splice.py
+import json, logging, re, threading
+
+import sass
+
+from .conv import VARIABLE_REF, BaseCache, Colour
+from .jobs import submit
+from .pool import PoolError
+from .sources import BLOCK_COMMENT, LINE_COMMENT
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# Splice Engine
+# ============================================================================
+#
+# Most edits to a Sheet only change colours and most colour variables end up
+# in the CSS exactly as they are, e.g. "color: $link-color".  For those the
+# CSS can be produced by substituting values into a template instead of
+# running a full Sass compile.
+#
+# The template is made by compiling a Version with a unique sentinel colour
+# for each colour variable and recording where the sentinels appear in the
+# output.  A variable is "simple" if changing its sentinel only changes its
+# own occurrences, variables that the stylesheets pass through functions
+# (e.g. "darken($btn-primary-bg, 10%)") are not.  Simple variables are found
+# by changing groups of sentinels at once and bisecting the groups that
+# don't behave.  Variables the source obviously uses in expressions are
+# excluded up front, this scan is required as a group test can miss uses
+# that happen to give the same result for both sentinels.
+
+HEX_COLOUR = re.compile(r'#[0-9a-fA-F]{6}\b')
+
+# sentinels are far apart in hue and on opposite sides of 50% lightness so
+# that functions and lightness tests applied to them can't give the same
+# result
+PRIMARY_START = 0x3c6e01
+ALTERNATE_START = 0xf0a1d2
+
+STATEMENT = re.compile(r'[^;{}]*[;{}]?')
+
+
+class SpliceError(Exception):
+    pass
+
+
+def make_sentinels(names, start, avoid, dark):
+    """Returns an OrderedDict of names mapped to unique six digit hex
+    colours, none of which appear in ``avoid``.
+
+    :param names: variable names to create sentinels for
+    :param start: integer value of the first colour to try
+    :param avoid: string (typically compiled CSS) the sentinels must not be
+        found in
+    :param dark: True if the sentinels must be below 50% lightness, False
+        if they must be above it
+    """
+    sentinels = {}
+    value = start
+    for name in names:
+        while True:
+            if value > 0xffffff:
+                raise SpliceError('Ran out of sentinel colours')
+
+            text = '#%06x' % value
+            colour = Colour(value >> 16, (value >> 8) & 0xff, value & 0xff)
+            value += 1
+            if (colour.to_hsl()[2] < 50) == dark and text not in avoid:
+                break
+
+        sentinels[name] = text
+
+    return sentinels
+
+
+def complex_names(source):
+    """Scans Sass source for global variables that are used in anything but
+    a plain declaration: function and mixin arguments, control directives,
+    interpolation and assignments to other variables.  Top level
+    declarations marked "!default" are skipped, those are the variables
+    being customized.
+
+    :param source: string containing the Sass, e.g. a flattened bundle
+    :returns: set of variable names
+    """
+    source = BLOCK_COMMENT.sub('', source)
+    source = LINE_COMMENT.sub('', source)
+
+    found = set([])
+    depth = 0
+    for match in STATEMENT.finditer(source):
+        statement = match.group(0)
+        body = statement.rstrip(';{}').strip()
+        if body and '$' in body:
+            is_default = depth == 0 and body.startswith('$') \
+                and body.endswith('!default')
+            if is_default:
+                pass
+            elif '(' in body or '#{' in body or body.startswith('@') \
+                    or body.startswith('$') or statement.endswith('{'):
+                found.update(VARIABLE_REF.findall(body))
+
+        if statement.endswith('{'):
+            depth += 1
+        elif statement.endswith('}'):
+            depth = max(depth - 1, 0)
+
+    return found
+
+
+def replace_sentinels(css, replacements):
+    """Replaces the sentinel colours found in a piece of CSS.
+
+    :param css: string to replace in
+    :param replacements: dict of sentinel strings mapped to their
+        replacement
+    """
+    def replace(match):
+        return replacements.get(match.group(0), match.group(0))
+
+    return HEX_COLOUR.sub(replace, css)
+
+
+class SpliceTemplate(object):
+    """Compiled CSS split at every place a simple colour variable appears.
+
+    :param parts: list alternating between literal pieces of CSS and the
+        names of the variables that go between them
+    :param simple: set of the names of the simple variables
+    """
+    def __init__(self, parts, simple):
+        self.parts = parts
+        self.simple = set(simple)
+
+    @classmethod
+    def build(cls, compile_values, bsv, source):
+        """Creates a template by compiling with sentinel values.  Raises
+        :class:`SpliceError` if the source isn't available or the template
+        doesn't reproduce the base CSS.
+
+        :param compile_values: callable that takes a dict of variable names
+            to values, compiles the Version with those values in place of
+            the base ones and returns the CSS
+        :param bsv: :class:`BStrapVars` of the Version without any
+            customizations
+        :param source: Sass source of the stylesheets, variables that it
+            uses in expressions are never considered simple.  If None the
+            source couldn't be read and no template is built.
+        """
+        if source is None:
+            raise SpliceError('Source is needed to find simple variables')
+
+        colours = bsv.colour_values
+        base = compile_values({})
+
+        excluded = complex_names(source)
+        names = [name for name in colours.keys() if name not in excluded]
+
+        primary = make_sentinels(names, PRIMARY_START, base, True)
+        alternate = make_sentinels(names, ALTERNATE_START,
+            base + ''.join(primary.values()), False)
+
+        template = compile_values(primary)
+
+        # change a group of sentinels, if only their occurrences change the
+        # whole group is simple, otherwise split it and try again
+        simple = set([])
+        pending = [names]
+        while pending:
+            group = pending.pop()
+            values = dict(primary)
+            values.update((name, alternate[name]) for name in group)
+            expected = replace_sentinels(template, dict(
+                (primary[name], alternate[name]) for name in group))
+
+            if compile_values(values) == expected:
+                simple.update(group)
+            elif len(group) > 1:
+                half = len(group) // 2
+                pending.append(group[:half])
+                pending.append(group[half:])
+
+        # variables that lost their sentinel go back to their expressions,
+        # anything those reference can't have a sentinel either or it would
+        # leak into them
+        for name in names:
+            if name not in simple:
+                simple.difference_update(bsv.graph.all_references(name))
+
+        # final template only uses sentinels for the simple variables so
+        # everything else has its real value
+        values = dict((name, primary[name]) for name in simple)
+        css = compile_values(values)
+        lookup = dict((primary[name], name) for name in simple)
+
+        parts = []
+        position = 0
+        for match in HEX_COLOUR.finditer(css):
+            name = lookup.get(match.group(0))
+            if name is None:
+                continue
+
+            parts.append(css[position:match.start()])
+            parts.append(name)
+            position = match.end()
+
+        parts.append(css[position:])
+
+        template = SpliceTemplate(parts, simple)
+        if template.render(colours) != base:
+            raise SpliceError('Template does not reproduce the base CSS')
+
+        return template
+
+    @classmethod
+    def from_json(cls, content):
+        d = json.loads(content)
+        return SpliceTemplate(d['parts'], d['simple'])
+
+    def to_json(self):
+        return json.dumps({
+            'parts':self.parts,
+            'simple':sorted(self.simple),
+        })
+
+    def render(self, values):
+        """Returns the CSS with the given values substituted.
+
+        :param values: dict of every simple variable mapped to its value
+        """
+        pieces = list(self.parts)
+        for i in range(1, len(pieces), 2):
+            pieces[i] = values[pieces[i]]
+
+        return ''.join(pieces)
+
+    def render_vars(self, bsv):
+        """Returns the CSS for a :class:`BStrapVars` or None if any of its
+        changed values (or their dependents) aren't simple colour variables
+        and a full compile is needed."""
+        if bsv.base_colours is None:
+            return None
+
+        colours = bsv.colour_values
+        for name in list(bsv.custom_values) + list(bsv.override_values):
+            if name not in bsv.all_components:
+                continue
+
+            if bsv.get_value(name) == bsv.all_components[name].value:
+                continue
+
+            affected = set(bsv.dependencies(name))
+            affected.add(name)
+            for found in affected:
+                if found not in self.simple or found not in colours:
+                    return None
+
+        values = dict(bsv.base_colours)
+        values.update(colours)
+        return self.render(values)
+
+
+# templates keyed by the Version's variables and source fingerprint, False
+# marks a Version that can't be spliced
+template_cache = BaseCache(size=8)
+
+# keys of the templates being built in the background
+_building = set()
+_building_lock = threading.Lock()
+
+
+def _build(key, build, store):
+    # returns the JSON for a template, an empty string if the Version can't
+    # be spliced or None if the compiler wasn't available and building
+    # should be tried again later
+    try:
+        content = build().to_json()
+    except (SpliceError, sass.CompileError) as e:
+        logger.info('Splicing not available: %s', e)
+        content = ''
+    except PoolError as e:
+        logger.warning('Splice template not built: %s', e)
+        return None
+
+    if store is not None:
+        store.set(key, content)
+
+    return content
+
+
+def _remember(key, content):
+    template = False
+    if content:
+        template = SpliceTemplate.from_json(content)
+
+    template_cache.put(key, template)
+    return template
+
+
+def _build_later(key, build, store):
+    with _building_lock:
+        if key in _building:
+            return
+
+        _building.add(key)
+
+    def run():
+        try:
+            content = _build(key, build, store)
+            if content is not None:
+                _remember(key, content)
+        finally:
+            with _building_lock:
+                _building.discard(key)
+
+    submit(run)
+
+
+def cached_template(key, build, store=None, background=False):
+    """Returns the :class:`SpliceTemplate` for a key, building it only if it
+    isn't in memory or in the store.  Returns None if the template can't be
+    built.
+
+    :param key: string identifying the Version and the state of its sources
+    :param build: callable that returns a new :class:`SpliceTemplate`
+    :param store: optional compiled CSS store (see bseditor.cache) used to
+        share templates between processes
+    :param background: if True a missing template is built as a background
+        job (see bseditor.jobs) and None is returned until it is ready, so
+        the caller never waits for the build's compiles
+    """
+    template = template_cache.get(key)
+    if template is None:
+        content = None
+        if store is not None:
+            content = store.get(key)
+
+        if content is None:
+            if background:
+                _build_later(key, build, store)
+
+                # background jobs may be turned off and run straight away
+                return template_cache.get(key) or None
+
+            content = _build(key, build, store)
+            if content is None:
+                return None
+
+        template = _remember(key, content)
+
+    return template or None
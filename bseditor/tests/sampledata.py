@@ -56,6 +56,17 @@ VARS_FILE_DICT = OrderedDict([
 # JSON version of test VARS file
 VARS_JSON = json.dumps(VARS_FILE_DICT)
 
+# JSON stored by a Version for the test VARS file, includes the colours
+VARS_STORE_DICT = OrderedDict(VARS_FILE_DICT)
+VARS_STORE_DICT['colours'] = OrderedDict([
+    ('gray-base', '#000'),
+    ('body-bg', '#fff'),
+    ('text-color', '#000'),
+    ('navbar-inverse-bg', '#222'),
+])
+
+VARS_STORE_JSON = json.dumps(VARS_STORE_DICT)
+
 # -----
 # bad file for checking error conditions
 ERROR_VARS_FILE = """
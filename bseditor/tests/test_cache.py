@@ -0,0 +1,205 @@
+import os, mock, sass, threading, time
+
+from django.test import override_settings
+
+from bseditor.cache import (compile_key, compile_sass, get_store,
+    MemoryStore, FileStore, DjangoCacheStore, SingleFlight)
+from bseditor.models import Version, Sheet
+from bseditor.sources import SourceRecord
+from bseditor.tests.sampledata import (EXPECTED_SASS_FILE,
+    SASS_FILE_CUSTOMIZED_DICT)
+from bseditor.tests.utils import BSEditorTest, create_fakestrap
+
+# ============================================================================
+# Test Class
+# ============================================================================
+
+class CacheTest(BSEditorTest):
+    def test_stores(self):
+        # -- MemoryStore
+        store = MemoryStore(max_size=10)
+        store.set('a', '12345')
+        store.set('b', '12345')
+        self.assertEqual('12345', store.get('a'))
+
+        # "b" is least recently used
+        store.set('c', '123')
+        self.assertEqual(None, store.get('b'))
+        self.assertEqual('12345', store.get('a'))
+        self.assertEqual('123', store.get('c'))
+        self.assertEqual(8, store.size)
+
+        store.clear()
+        self.assertEqual(None, store.get('a'))
+        self.assertEqual(0, store.size)
+
+        # -- FileStore
+        directory = os.path.join(self.dir_name, 'css_cache')
+        store = FileStore(directory, max_size=10)
+        store.set('a', '12345')
+        store.set('b', '12345')
+        self.assertEqual('12345', store.get('a'))
+
+        # make "b" the oldest
+        os.utime(os.path.join(directory, 'b.css'), (1, 1))
+        store.set('c', '123')
+        self.assertEqual(None, store.get('b'))
+        self.assertEqual('12345', store.get('a'))
+        self.assertEqual('123', store.get('c'))
+
+        # entries are shared with other instances
+        store2 = FileStore(directory)
+        self.assertEqual('123', store2.get('c'))
+
+        store.clear()
+        self.assertEqual(None, store2.get('a'))
+        self.assertEqual([], os.listdir(directory))
+
+        # failed writes don't leave temporary files
+        with mock.patch('bseditor.cache.os.rename') as patched:
+            patched.side_effect = OSError('nope')
+            with self.assertRaises(OSError):
+                store.set('a', '12345')
+
+        self.assertEqual([], os.listdir(directory))
+
+        # -- DjangoCacheStore
+        store = DjangoCacheStore()
+        self.assertEqual(None, store.get('a'))
+        store.set('a', '12345')
+        self.assertEqual('12345', store.get('a'))
+        store.clear()
+
+    def test_compile(self):
+        source = '$x:#fff; .a { color: $x; }'
+        self.assertNotEqual(compile_key(source), compile_key(source, 'f'))
+
+        # default is an in-memory store
+        self.assertTrue(isinstance(get_store(), MemoryStore))
+        get_store().clear()
+
+        expected = sass.compile(string=source)
+        with mock.patch('bseditor.cache.sass.compile',
+                wraps=sass.compile) as patched:
+            self.assertEqual(expected, compile_sass(source))
+            self.assertEqual(expected, compile_sass(source))
+            self.assertEqual(1, patched.call_count)
+
+            # new fingerprint means new compile
+            compile_sass(source, 'changed')
+            self.assertEqual(2, patched.call_count)
+
+            # configured stores
+            directory = os.path.join(self.dir_name, 'compile_cache')
+            config = {
+                'STORE':'bseditor.cache.FileStore',
+                'OPTIONS':{
+                    'directory':directory,
+                },
+            }
+            with override_settings(BSEDITOR_COMPILE_CACHE=config):
+                self.assertTrue(isinstance(get_store(), FileStore))
+                self.assertEqual(expected, compile_sass(source))
+                self.assertEqual(expected, compile_sass(source))
+                self.assertEqual(3, patched.call_count)
+                self.assertEqual(1, len(os.listdir(directory)))
+
+            # disabled
+            with override_settings(BSEDITOR_COMPILE_CACHE=None):
+                self.assertEqual(None, get_store())
+                compile_sass(source)
+                compile_sass(source)
+                self.assertEqual(5, patched.call_count)
+
+    def test_sheet(self):
+        get_store().clear()
+
+        compile_filename, variables_filename = create_fakestrap(self.dir_name)
+        version = Version.factory('v1', variables_filename, compile_filename)
+        sheet1 = Sheet.factory('s1', version, SASS_FILE_CUSTOMIZED_DICT)
+        sheet2 = Sheet.factory('s2', version, SASS_FILE_CUSTOMIZED_DICT)
+
+        fingerprint = version.source_fingerprint()
+
+        # identical variables across sheets only compile once
+        with mock.patch('bseditor.cache.sass.compile',
+                wraps=sass.compile) as patched:
+            self.assertEqual(EXPECTED_SASS_FILE, sheet1.compiled_string())
+            self.assertEqual(EXPECTED_SASS_FILE, sheet2.compiled_string())
+            self.assertEqual(1, patched.call_count)
+
+            # touching a file doesn't change the fingerprint, the new
+            # modification time is recorded
+            os.utime(compile_filename, (1, 1))
+            self.assertEqual(fingerprint, version.source_fingerprint())
+            version = Version.objects.get(id=version.id)
+            record = SourceRecord.from_json(version._sources)
+            self.assertEqual(1, record.files[version.compile_filename]['mtime'])
+
+            # changing an imported file invalidates
+            with open(compile_filename, 'a') as f:
+                f.write('\n')
+            os.utime(compile_filename, (2, 2))
+
+            self.assertNotEqual(fingerprint, version.source_fingerprint())
+            sheet1 = Sheet.objects.get(id=sheet1.id)
+            self.assertEqual(EXPECTED_SASS_FILE, sheet1.compiled_string())
+            self.assertEqual(2, patched.call_count)
+
+    def test_single_flight(self):
+        get_store().clear()
+        source = '$x:#000; .a { color: $x; }'
+        expected = sass.compile(string=source)
+
+        started = threading.Event()
+        release = threading.Event()
+        def slow_compile(**kwargs):
+            started.set()
+            release.wait()
+            return expected
+
+        results = []
+        def request():
+            results.append(compile_sass(source))
+
+        # concurrent identical compiles wait for the first one, with and
+        # without a store, across processes through lock files
+        directory = os.path.join(self.dir_name, 'locks')
+        configs = [
+            {},
+            {'BSEDITOR_COMPILE_CACHE':None},
+            {'BSEDITOR_COMPILE_LOCK_DIR':directory},
+        ]
+        for config in configs:
+            get_store().clear()
+            started.clear()
+            release.clear()
+            del results[:]
+
+            with override_settings(**config):
+                with mock.patch('bseditor.cache.sass.compile',
+                        side_effect=slow_compile) as patched:
+                    threads = [threading.Thread(target=request)
+                        for _ in range(5)]
+                    threads[0].start()
+                    started.wait()
+                    for thread in threads[1:]:
+                        thread.start()
+
+                    time.sleep(0.1)
+                    release.set()
+                    for thread in threads:
+                        thread.join()
+
+                    self.assertEqual(1, patched.call_count)
+                    self.assertEqual([expected] * 5, results)
+
+        # locks are striped over a fixed set of files
+        key = compile_key(source)
+        self.assertEqual([key[:2] + '.lock'], os.listdir(directory))
+
+        # errors are raised to the caller
+        flight = SingleFlight()
+        self.assertEqual(3, flight.do('a', lambda: 3))
+        with self.assertRaises(KeyError):
+            flight.do('a', mock.Mock(side_effect=KeyError))
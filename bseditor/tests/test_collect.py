@@ -0,0 +1,71 @@
+import json, os
+
+from django.contrib.staticfiles.storage import (StaticFilesStorage,
+    ManifestStaticFilesStorage)
+from django.test import TestCase, override_settings
+from wrench.contexts import temp_directory
+
+from bseditor.collect import collect_file, collect_sheet, static_name
+
+# ============================================================================
+# Test Class
+# ============================================================================
+
+class FakeSheet(object):
+    def __init__(self, full_filename):
+        self.full_filename = full_filename
+
+
+class CollectTest(TestCase):
+    def test_collect(self):
+        with temp_directory() as dir_name:
+            deploy_dir = os.path.join(dir_name, 'deploy')
+            static_root = os.path.join(dir_name, 'static')
+            os.mkdir(deploy_dir)
+            os.mkdir(static_root)
+
+            filenames = []
+            for name in ['a.css', 'b.css']:
+                filename = os.path.join(deploy_dir, name)
+                filenames.append(filename)
+                with open(filename, 'w') as f:
+                    f.write('.%s { color: red; }' % name[0])
+
+            # -- plain storage
+            with override_settings(STATICFILES_DIRS=(deploy_dir, ),
+                    STATIC_ROOT=static_root):
+                self.assertEqual('a.css', static_name(filenames[0]))
+                collect_sheet(FakeSheet(filenames[0]))
+                self.assertEqual(['a.css'], os.listdir(static_root))
+
+                # replaces the existing file
+                with open(filenames[0], 'w') as f:
+                    f.write('.a { color: blue; }')
+                collect_file(filenames[0], StaticFilesStorage())
+                with open(os.path.join(static_root, 'a.css')) as f:
+                    self.assertEqual('.a { color: blue; }', f.read())
+
+            # -- prefixed directory and manifest storage
+            os.remove(os.path.join(static_root, 'a.css'))
+            dirs = (('css', deploy_dir), )
+            with override_settings(STATICFILES_DIRS=dirs,
+                    STATIC_ROOT=static_root):
+                storage = ManifestStaticFilesStorage()
+                self.assertEqual('css/a.css',
+                    collect_file(filenames[0], storage))
+                self.assertEqual('css/b.css',
+                    collect_file(filenames[1], storage))
+
+                # both files are in the manifest
+                with open(os.path.join(static_root, 'staticfiles.json')) as f:
+                    manifest = json.load(f)
+
+                for name in ['css/a.css', 'css/b.css']:
+                    hashed = manifest['paths'][name]
+                    self.assertNotEqual(name, hashed)
+                    self.assertTrue(os.path.exists(os.path.join(
+                        static_root, hashed)))
+
+                storage = ManifestStaticFilesStorage()
+                self.assertEqual(manifest['paths']['css/a.css'],
+                    storage.stored_name('css/a.css'))
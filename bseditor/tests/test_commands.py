@@ -1,14 +1,22 @@
 # bseditor.tests.test_commands.py
-import os
+import os, json
 
 from django.core.management import call_command
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
-from bseditor.models import Version
+from bseditor.models import Version, Sheet
 from bseditor.management.commands.defaultversion import versions
+from bseditor.tests.sampledata import (EXPECTED_SASS_FILE,
+    SASS_FILE_CUSTOMIZED_DICT)
+from bseditor.tests.utils import BSEditorTest, create_fakestrap
 
 from wrench.contexts import capture_stdout
 
+collected = []
+
+def collect_hook(sheet):
+    collected.append(sheet.name)
+
 # ============================================================================
 
 class CommandTests(TestCase):
@@ -27,3 +35,67 @@ class CommandTests(TestCase):
             call_command('createversion', version[0], vars_filename, 
                 compile_filename)
             self.assertEqual(1, Version.objects.count())
+
+
+class DeployCommandTest(BSEditorTest):
+    def test_deploy_sheets(self):
+        compile_filename, variables_filename = create_fakestrap(self.dir_name)
+        version = Version.factory('v1', variables_filename, compile_filename)
+        sheet1 = Sheet.factory('s1', version, SASS_FILE_CUSTOMIZED_DICT)
+        Sheet.factory('s2', version, SASS_FILE_CUSTOMIZED_DICT)
+
+        output_dir = os.path.join(self.dir_name, 'deploysheets')
+        os.mkdir(output_dir)
+        settings = {
+            'BSEDITOR_DEPLOY_DIR':output_dir,
+            'BSEDITOR_COLLECT_ON_DEPLOY':True,
+            'BSEDITOR_COLLECT_HOOK':
+                'bseditor.tests.test_commands.collect_hook',
+        }
+        with override_settings(**settings):
+            with capture_stdout() as output:
+                call_command('deploysheets', processes=1)
+
+            self.assertIn(
+                'Deployed 2 (2 written), skipped 0 unchanged, 0 failed',
+                output.getvalue())
+            self.assertEqual(['s1', 's2'], collected)
+            with open(os.path.join(output_dir, 's1.css')) as f:
+                self.assertEqual(EXPECTED_SASS_FILE, f.read())
+
+            # nothing changed
+            del collected[:]
+            with capture_stdout() as output:
+                call_command('deploysheets', processes=1)
+
+            self.assertIn('Deployed 0 (0 written), skipped 2',
+                output.getvalue())
+            self.assertEqual([], collected)
+
+            # changed sheet, filtered by name and version
+            sheet1._store = json.dumps({'body-bg':'#0f0'})
+            sheet1.save()
+            with capture_stdout() as output:
+                call_command('deploysheets', 's1', 's2', processes=1,
+                    version_name='v1')
+
+            self.assertIn('Deployed 1 (1 written), skipped 1',
+                output.getvalue())
+            self.assertEqual(['s1'], collected)
+
+            with capture_stdout() as output:
+                call_command('deploysheets', 's2', processes=1,
+                    version_name='other')
+
+            self.assertIn('Deployed 0 (0 written), skipped 0',
+                output.getvalue())
+
+            # forced, compiled in parallel, output is the same so nothing is
+            # written or collected
+            del collected[:]
+            with capture_stdout() as output:
+                call_command('deploysheets', processes=2, force=True)
+
+            self.assertIn('Deployed 2 (0 written), skipped 0',
+                output.getvalue())
+            self.assertEqual([], collected)
@@ -1,10 +1,11 @@
-import json, runpy
+import json, mock, os, runpy, sass
 from collections import OrderedDict
 
 from django.test import TestCase
 from wrench.contexts import temp_file, capture_stdout
 
-from bseditor.conv import BStrapVars, Section, Component
+from bseditor.conv import (ordered_json, BStrapVars, Section, Component,
+    BaseCache, base_cache, ColourEvaluator, DependencyGraph, Unsupported)
 from bseditor.tests.sampledata import (VARS_FILE, VARS_JSON, ERROR_VARS_FILE,
     ERROR_VARS_JSON)
 
@@ -13,6 +14,47 @@ from bseditor.tests.sampledata import (VARS_FILE, VARS_JSON, ERROR_VARS_FILE,
 def pprint(data):   # pragma: no cover
     print(json.dumps(data, sort_keys=True, indent=4, separators=(',', ': ')))
 
+
+BOOTSTRAP_VARS = os.path.abspath(os.path.join(os.path.dirname(__file__),
+    '../static/bseditor/sass/bootstrap-3.3.5/bootstrap/_variables.scss'))
+
+# colour expressions outside of those used by Bootstrap for checking the
+# evaluator against the sass compiler
+EXTRA_EXPRESSIONS = OrderedDict([
+    ('base', '#8a6d3b'),
+    ('named', 'red'),
+    ('upper', '#ABCDEF'),
+    ('light', 'lighten($base, 27.3%)'),
+    ('dark', 'darken($named, 12%)'),
+    ('sat', 'saturate(#888, 10%)'),
+    ('desat', 'desaturate($base, 20%)'),
+    ('hue', 'adjust-hue($base, 190deg)'),
+    ('mix1', 'mix(#abc, #123)'),
+    ('mix2', 'mix($light, $dark, 33.3333%)'),
+    ('mix3', 'mix(rgba(0,0,0,.5), #fff, 25%)'),
+    ('rgb', 'rgb(10, 200, 30)'),
+    ('rgba1', 'rgba(255, 0, 0, 1)'),
+    ('rgba2', 'rgba($base, .333333333)'),
+    ('hsl', 'hsl(120, 50%, 50%)'),
+    ('hsla', 'hsla(300, 20%, 70%, .7)'),
+    ('opacify', 'opacify(rgba(1, 2, 3, .2), .15)'),
+    ('transp', 'fade-out(#fff, .75)'),
+    ('grayscale', 'grayscale(#8a6d3c)'),
+    ('complement', 'complement(#6b717f)'),
+    ('invert', 'invert(#6b717f)'),
+    ('white', 'lighten(#000, 100%)'),
+    ('cyan', 'rgb(0, 255, 255)'),
+    ('percent', 'rgb(50%, 0, 0)'),
+    ('percenta', 'rgba(50%, 10%, 0, .5)'),
+    ('maths', 'darken($base, (10% / 2) + 1)'),
+    ('iffy', 'if(true, #010203, #fff)'),
+    ('size', '(14px * 1.5)'),
+    ('list', '0 1px 2px rgba(0,0,0,.6)'),
+    ('interp', '#{$named}'),
+    ('unquoted', 'unquote("#fff")'),
+    ('nope', 'unknown-fn(#fff)'),
+])
+
 # ============================================================================
 # Test Class
 # ============================================================================
@@ -113,6 +155,49 @@ class BStrapVarsTest(TestCase):
         result = bsv.dependencies(self.comp2_1.name)
         self.assertEqual(result, set([]))
 
+    def test_dependencies(self):
+        data = OrderedDict([
+            ('nonsections', OrderedDict([
+                ('gray-base', {'value':'#000'}),
+                ('gray-base-light', {'value':'#333'}),
+                ('text', {'value':'$gray-base-light'}),
+                ('link', {'value':'darken($gray-base, 10%)'}),
+                ('link-hover', {'value':'lighten($link, 5%)'}),
+                ('border', {'value':'1px solid $link-hover'}),
+            ])),
+        ])
+        bsv = BStrapVars.factory(data)
+
+        # "$gray-base-light" must not count as a reference to "gray-base"
+        expected = set(['link', 'link-hover', 'border'])
+        self.assertEqual(expected, bsv.dependencies('gray-base'))
+        self.assertEqual(set(['text']), bsv.dependencies('gray-base-light'))
+        self.assertEqual(set([]), bsv.dependencies('border'))
+
+        # forward edges and their closure
+        self.assertEqual(set(['link']), bsv.graph.references['link-hover'])
+        self.assertEqual(set(['gray-base', 'link', 'link-hover']),
+            bsv.graph.all_references('border'))
+
+        # compact reverse edges
+        expected = OrderedDict([
+            ('gray-base', ['link']),
+            ('gray-base-light', ['text']),
+            ('link', ['link-hover']),
+            ('link-hover', ['border']),
+        ])
+        self.assertEqual(expected, bsv.graph.adjacency())
+
+        # overrides change the graph
+        bsv = BStrapVars.factory(data, overrides={'text':'$gray-base'})
+        self.assertEqual(set(['text', 'link', 'link-hover', 'border']),
+            bsv.dependencies('gray-base'))
+        self.assertEqual(set([]), bsv.dependencies('gray-base-light'))
+
+        expected['gray-base'] = ['link', 'text']
+        del expected['gray-base-light']
+        self.assertEqual(expected, bsv.graph.adjacency())
+
     def test_custom_and_overrides(self):
         c = {
             self.comp1_1.name:'#AAA',
@@ -168,6 +253,227 @@ class BStrapVarsTest(TestCase):
         self.assertEqual(result_base, expected_base)
         self.assertEqual(result_custom, expected_custom)
 
+    def test_base_cache(self):
+        base_cache.clear()
+        content = json.dumps(self.data)
+
+        bsv1 = BStrapVars.factory(content, {self.comp1_1.name:'#AAA'})
+        self.assertEqual(1, base_cache.misses)
+        bsv2 = BStrapVars.factory(content)
+        self.assertEqual(1, base_cache.hits)
+
+        # base is shared, customizations are not
+        self.assertIs(bsv1.all_components, bsv2.all_components)
+        self.assertEqual('#AAA', bsv1.get_value(self.comp1_1.name))
+        self.assertEqual('#000', bsv2.get_value(self.comp1_1.name))
+        self.assertEqual('#222222', bsv2.colour_values[self.comp1_2.name])
+
+        # dictionaries aren't cached
+        BStrapVars.factory(self.data)
+        self.assertEqual(1, len(base_cache))
+
+        # LRU eviction
+        cache = BaseCache(size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+        expected = {
+            'hits':2,
+            'misses':1,
+            'evictions':1,
+            'size':2,
+            'max_size':2,
+        }
+        self.assertEqual(expected, cache.info())
+
+    def test_shared_base(self):
+        base_cache.clear()
+        bsv = BStrapVars.factory_from_sass_file(BOOTSTRAP_VARS)
+        content = bsv.base_to_json()
+
+        bsv1 = BStrapVars.factory(content)
+        self.assertTrue(bsv1.base.frozen)
+        with self.assertRaises(TypeError):
+            bsv1.add_component('foo', '#fff')
+        with self.assertRaises(TypeError):
+            bsv1.add_section('foo')
+
+        # no customizations means the base graph is shared as is
+        bsv2 = BStrapVars.factory(content)
+        self.assertIs(bsv1.base, bsv2.base)
+        self.assertIs(bsv1.graph, bsv2.graph)
+
+        # patched graph only holds what changed and matches a full build
+        custom = {'brand-primary':'darken($gray-dark, 5%)'}
+        overrides = {
+            'link-color':'$brand-success',
+            'gray-dark':'',
+            'not-a-component':'$brand-info',
+        }
+        bsv3 = BStrapVars.factory(content, custom, overrides)
+        self.assertIs(bsv1.graph, bsv3.graph._base)
+        self.assertEqual(set(['brand-primary', 'link-color']),
+            set(bsv3.graph.references.keys()))
+
+        full = DependencyGraph(bsv3.all_value_pairs())
+        for name in bsv3.all_components.keys():
+            self.assertEqual(full.all_dependents(name),
+                bsv3.graph.all_dependents(name))
+            self.assertEqual(full.all_references(name),
+                bsv3.graph.all_references(name))
+
+        # shared base is unchanged
+        self.assertNotIn('brand-primary', bsv1.dependencies('gray-dark'))
+        self.assertIn('link-color', bsv1.dependencies('brand-primary'))
+
+    def test_stored_colours(self):
+        bsv = BStrapVars.factory(self.data)
+        content = bsv.base_to_json(colours=True)
+        self.assertEqual(self.colour_values, ordered_json(content)['colours'])
+
+        # loading with stored colours and no customizations doesn't compile
+        with mock.patch('bseditor.conv.sass.compile') as patched:
+            bsv = BStrapVars.factory(content)
+            self.assertFalse(patched.called)
+
+        self.assertEqual(self.colour_values, bsv.colour_values)
+
+        # customizations only re-evaluate what they affect
+        bsv = BStrapVars.factory(content, {self.comp1_2.name:'#111'})
+        expected = OrderedDict(self.colour_values)
+        expected[self.comp1_2.name] = '#111'
+        expected[self.comp1_3.name] = '#333333'
+        self.assertEqual(expected, bsv.colour_values)
+
+        # affected value that is no longer a colour is removed
+        bsv = BStrapVars.factory(content, overrides={self.comp2_1.name:'1px'})
+        expected = OrderedDict(self.colour_values)
+        del expected[self.comp2_1.name]
+        self.assertEqual(expected.keys(), bsv.colour_values.keys())
+
+    def test_update_colours(self):
+        bsv = BStrapVars.factory(self.data)
+        previous = bsv.colour_values
+
+        overrides = {
+            self.comp1_2.name:'#111',
+            self.comp1_3.name:'lighten($gray-base, 20%)',
+        }
+        bsv = BStrapVars.factory(self.data, overrides=overrides)
+        define = ColourEvaluator.define
+        with mock.patch.object(ColourEvaluator, 'define', autospec=True,
+                side_effect=define) as patched:
+            result = bsv.update_colours(previous, [self.comp1_3.name, 'nope'])
+
+            # only the changed item and what it references are evaluated
+            names = [args[0][1] for args in patched.call_args_list]
+            self.assertEqual([self.comp1_1.name, self.comp1_3.name], names)
+
+        # gray-darker wasn't listed as changed so its previous value is kept
+        expected = OrderedDict(self.colour_values)
+        expected[self.comp1_3.name] = '#333333'
+        self.assertEqual(expected, result)
+
+        # overridden compounded no longer depends on gray-darker
+        result = bsv.update_colours(previous, [self.comp1_2.name])
+        expected = OrderedDict(self.colour_values)
+        expected[self.comp1_2.name] = '#111'
+        self.assertEqual(expected, result)
+
+        # nothing changed, nothing evaluated
+        with mock.patch.object(ColourEvaluator, 'define') as patched:
+            result = bsv.update_colours(previous, [])
+            self.assertFalse(patched.called)
+            self.assertEqual(previous, result)
+
+        # same restrictions when falling back to the compiler
+        with mock.patch('bseditor.conv.sass.compile',
+                wraps=sass.compile) as patched:
+            result = bsv._compile_colours(set([self.comp1_3.name]))
+            self.assertEqual({self.comp1_3.name:'#333333'}, result)
+
+            src = patched.call_args[1]['string']
+            self.assertIn('$gray-base', src)
+            self.assertNotIn('capture("gray-base"', src)
+            self.assertNotIn('gray-darker', src)
+            self.assertNotIn('body-bg', src)
+            self.assertIn('capture("compounded"', src)
+
+    def test_evaluator(self):
+        # check the python evaluator against the sass compiler for every
+        # variable in the bundled bootstrap
+        bsv = BStrapVars.factory_from_sass_file(BOOTSTRAP_VARS)
+        with mock.patch('bseditor.conv.sass.compile') as patched:
+            evaluated = bsv._evaluate_colours()
+            self.assertFalse(patched.called)
+
+        self.assertEqual(bsv._compile_colours(), evaluated)
+
+        # other expressions, some of which need the sass compiler
+        data = {'nonsections':OrderedDict(
+            (name, {'value':value}) for name, value in 
+            EXTRA_EXPRESSIONS.items())}
+        bsv = BStrapVars.factory(data)
+        with mock.patch('bseditor.conv.sass.compile', 
+                wraps=sass.compile) as patched:
+            evaluated = bsv._evaluate_colours()
+            self.assertEqual(1, patched.call_count)
+
+        self.assertEqual(bsv._compile_colours(), evaluated)
+
+        # compiled colours are written the way the compiler writes them,
+        # including strings that are colours
+        self.assertEqual('#ABCDEF', evaluated['upper'])
+        self.assertEqual('red', evaluated['interp'])
+        self.assertEqual('#fff', evaluated['unquoted'])
+
+        # unsupported expressions
+        evaluator = ColourEvaluator()
+        for value in ['$undefined', '12px/1.5', '#{$x}', '#fff !important',
+                'lighten(#fff)', 'lighten(#fff, 200%)', 'rgba(1, 2)',
+                '#abcd', '1px + #fff', '1px + 1em', '1px * 1px', '$x -1',
+                '(1px / 0)', '(1px / 1em)', 'RED', 'darken(1px, 10%)',
+                '(#fff', '#abcdeg', 'fn(1 2 3 +)', ')', 'rgb(50%, 0, 0)']:
+            with self.assertRaises(Unsupported):
+                evaluator.evaluate(value)
+
+        # failures cascade to anything using the variable
+        with self.assertRaises(Unsupported):
+            evaluator.define('bad', 'unknown-fn(#fff)')
+        with self.assertRaises(Unsupported):
+            evaluator.evaluate('lighten($bad, 10%)')
+
+        # non-colours
+        self.assertEqual(None, evaluator.evaluate('null'))
+        self.assertEqual(False, evaluator.evaluate('false'))
+        self.assertEqual(2, evaluator.evaluate('round(1.5)').value)
+        self.assertEqual('%', evaluator.evaluate('percentage(.5)').unit)
+        self.assertEqual('px', evaluator.evaluate('(3px - 1)').unit)
+        self.assertEqual(1, evaluator.evaluate('(2px / 2px)').value)
+        self.assertEqual('transparent',
+            evaluator.evaluate('rgba(#000, 0)').to_css())
+
+    def test_lazy_detection(self):
+        with mock.patch('bseditor.conv.BStrapVars._evaluate_colours') as \
+                patched:
+            patched.return_value = OrderedDict()
+            bsv = BStrapVars.factory(self.data, {self.comp1_1.name:'#AAA'})
+            list(bsv.all_value_pairs())
+            self.assertFalse(patched.called)
+
+            bsv.colour_values
+            self.assertEqual(1, patched.call_count)
+
+            # only detected once
+            bsv.colour_values
+            self.assertEqual(1, patched.call_count)
+
+            BStrapVars.factory(self.data, eager=True)
+            self.assertEqual(2, patched.call_count)
+
     def test_file_parse(self):
         # write VARS_FILE into a file that gets cleaned up, then test parsing it
         with temp_file() as filename:
@@ -0,0 +1,41 @@
+import threading
+
+from django.test import TestCase, override_settings
+from wrench.logtools.utils import silence_logging
+
+from bseditor.jobs import get_executor, submit, JobExecutor
+
+# ============================================================================
+# Test Class
+# ============================================================================
+
+class JobsTest(TestCase):
+    @silence_logging
+    def test_executor(self):
+        results = []
+        def job(value):
+            results.append((value, threading.current_thread().name))
+
+        # inline
+        with override_settings(BSEDITOR_DEPLOY_THREADS=0):
+            self.assertEqual(None, get_executor())
+            submit(job, 1)
+            self.assertEqual([(1, threading.current_thread().name)], results)
+
+        # background
+        executor = JobExecutor(threads=2)
+        for value in range(5):
+            executor.submit(job, value)
+
+        # failing jobs don't stop the threads
+        executor.submit(job)
+        executor.join()
+
+        self.assertEqual(2, len(executor._workers))
+        self.assertEqual(6, len(results))
+        for _, name in results[1:]:
+            self.assertNotEqual(threading.current_thread().name, name)
+
+        with override_settings(BSEDITOR_DEPLOY_THREADS=3):
+            self.assertEqual(3, get_executor().threads)
+            self.assertTrue(get_executor() is get_executor())
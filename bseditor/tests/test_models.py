@@ -3,13 +3,14 @@ import os, mock
 from django.contrib import messages
 from django.template import Template, Context
 from django.test import override_settings
-from awl.waelsteng import AdminToolsMixin, messages_from_response
+from awl.waelsteng import (AdminToolsMixin, FakeRequest,
+    messages_from_response)
 from wrench.utils import parse_link
 
 from bseditor.admin import VersionAdmin, SheetAdmin
 from bseditor.conv import ordered_json
 from bseditor.models import Version, Sheet, PreviewSheet
-from bseditor.tests.sampledata import (VARS_JSON, EXPECTED_SASS_FILE,
+from bseditor.tests.sampledata import (VARS_STORE_JSON, EXPECTED_SASS_FILE,
     EXPECTED_SASS_PREVIEW_FILE, SASS_FILE_CUSTOMIZED_DICT,
     SASS_FILE_OVERRIDES_DICT)
 
@@ -35,7 +36,7 @@ class ModelsTest(BSEditorTest, AdminToolsMixin):
         version = Version.factory('v1', variables_filename, compile_filename)
 
         # verify load/compile worked
-        self.assertEqual(version._store, VARS_JSON)
+        self.assertEqual(version._store, VARS_STORE_JSON)
 
         # -- test Version Admin
         version_admin = VersionAdmin(Version, self.site)
@@ -93,7 +94,7 @@ class ModelsTest(BSEditorTest, AdminToolsMixin):
 
             # check last compile record is there
             fname = os.path.join(output_dir, 'last_compile.txt')
-            os.path.isfile(fname)
+            self.assertTrue(os.path.isfile(fname))
 
             # verify the created CSS file
             fname = os.path.join(output_dir, 's1.css')
@@ -103,12 +104,67 @@ class ModelsTest(BSEditorTest, AdminToolsMixin):
             self.assertEqual(EXPECTED_SASS_FILE, result)
             self.assertNotEqual(None, sheet.last_deploy)
 
+            # deploy metadata is recorded
+            out_of_date = Sheet.out_of_date_query()
+            sheet = Sheet.objects.get(id=sheet.id)
+            self.assertEqual(len(EXPECTED_SASS_FILE), sheet.output_size)
+            self.assertEqual(version.source_fingerprint(),
+                sheet.deploy_fingerprint)
+            self.assertTrue(sheet.compile_duration >= 0)
+            self.assertFalse(Sheet.objects.filter(out_of_date,
+                id=sheet.id).exists())
+
+            request = FakeRequest(user=self.admin_user)
+            qs = sheet_admin.get_queryset(request)
+            self.assertFalse(self.field_value(sheet_admin, qs.get(id=sheet.id),
+                'show_out_of_date'))
+
+            # edited sheets and changed sources are out of date
+            sheet.save()
+            self.assertTrue(Sheet.objects.filter(out_of_date,
+                id=sheet.id).exists())
+            sheet.deploy()
+            Version.objects.filter(id=version.id).update(fingerprint='x')
+            self.assertTrue(Sheet.objects.filter(out_of_date,
+                id=sheet.id).exists())
+            version = Version.objects.get(id=version.id)
+
+            # unchanged output isn't rewritten
+            os.utime(sheet.full_filename, (1, 1))
+            self.assertFalse(sheet.deploy())
+            self.assertEqual(1, os.path.getmtime(sheet.full_filename))
+
+            # without a recorded digest the file contents are compared
+            sheet.output_digest = ''
+            self.assertFalse(sheet.deploy())
+
+            with open(sheet.full_filename, 'w') as f:
+                f.write('changed')
+            self.assertTrue(sheet.deploy())
+            self.assertEqual(['s1.css'], [name for name in
+                os.listdir(output_dir) if name.endswith('.css')])
+
+            # failed writes don't leave temporary files to be collected
+            os.remove(sheet.full_filename)
+            with mock.patch('bseditor.cache.os.rename') as patched:
+                patched.side_effect = OSError('nope')
+                with self.assertRaises(OSError):
+                    sheet.deploy()
+
+            self.assertEqual([], [name for name in os.listdir(output_dir)
+                if name.endswith('.tmp')])
+            self.assertTrue(sheet.deploy())
+
             # -- test deployment hooks
             hook = 'bseditor.tests.test_models.fake_deploy_hook'
             with override_settings(BSEDITOR_COLLECT_ON_DEPLOY=True):
 
                 # check with custom hook
+                # only changed files get collected
                 with override_settings(BSEDITOR_COLLECT_HOOK=hook):
+                    sheet.deploy()
+
+                    os.remove(sheet.full_filename)
                     with self.assertRaises(GotHereError):
                         sheet.deploy()
 
@@ -116,6 +172,7 @@ class ModelsTest(BSEditorTest, AdminToolsMixin):
                 #call_command = 'django.core.management.call_command'
                 call_command = 'bseditor.models.call_command'
                 with mock.patch(call_command) as patched:
+                    os.remove(sheet.full_filename)
                     sheet.deploy()
                     self.assertTrue(patched.called)
                     self.assertEqual(patched.call_args, (('collectstatic',
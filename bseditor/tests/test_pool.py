@@ -0,0 +1,81 @@
+import threading, time
+
+import sass
+from django.test import TestCase, override_settings
+from wrench.logtools.utils import silence_logging
+
+from bseditor.cache import compile_sass, get_store
+from bseditor.pool import (get_pool, CompilePool, CompileTimeout, PoolFull,
+    PoolError)
+
+SOURCE = '$x:#fff; .a { color: $x; }'
+
+# never finishes
+RUNAWAY = '$i: 0; @while $i < 1 { .a { width: 1px; } }'
+
+# ============================================================================
+# Test Class
+# ============================================================================
+
+class PoolTest(TestCase):
+    @silence_logging
+    def test_pool(self):
+        expected = sass.compile(string=SOURCE)
+
+        pool = CompilePool(processes=1, timeout=2, max_queue=0, max_jobs=2)
+        try:
+            self.assertEqual(expected, pool.compile(SOURCE))
+            self.assertEqual(expected, pool.compile(SOURCE))
+            self.assertEqual(1, pool.started)
+
+            # worker recycled after max_jobs
+            self.assertEqual(expected, pool.compile(SOURCE))
+            self.assertEqual(2, pool.started)
+
+            # errors in the source come back as compile errors
+            with self.assertRaises(sass.CompileError):
+                pool.compile('.a { color: $undefined; }')
+
+            # runaway compiles are killed, the worker is replaced
+            with self.assertRaises(CompileTimeout):
+                pool.compile(RUNAWAY)
+
+            self.assertEqual(expected, pool.compile(SOURCE))
+            self.assertEqual(4, pool.started)
+
+            # nothing may wait while the only worker is busy
+            thread = threading.Thread(target=self._runaway, args=(pool,))
+            thread.start()
+            time.sleep(0.5)
+            with self.assertRaises(PoolFull):
+                pool.compile(SOURCE)
+
+            thread.join()
+        finally:
+            pool.close()
+
+        with self.assertRaises(PoolError):
+            pool.compile(SOURCE)
+
+        # configured pool is used by compile_sass
+        self.assertEqual(None, get_pool())
+        config = {
+            'processes':1,
+            'timeout':2,
+        }
+        with override_settings(BSEDITOR_COMPILE_POOL=config):
+            pool = get_pool()
+            self.assertTrue(isinstance(pool, CompilePool))
+
+            get_store().clear()
+            self.assertEqual(expected, compile_sass(SOURCE))
+            self.assertEqual(1, pool.started)
+
+        self.assertEqual(None, get_pool())
+        self.assertTrue(pool.closed)
+
+    def _runaway(self, pool):
+        try:
+            pool.compile(RUNAWAY)
+        except CompileTimeout:
+            pass
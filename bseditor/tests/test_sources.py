@@ -0,0 +1,153 @@
+import os, sass
+
+from django.test import TestCase
+from wrench.contexts import temp_directory
+
+from bseditor.sources import (import_names, resolve_import, import_graph,
+    bundled_source, chain_source, SourceBundle, SourceRecord, Unbundleable)
+
+BOOTSTRAP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+    '../static/bseditor/sass/bootstrap-3.3.5'))
+
+# ============================================================================
+# Test Class
+# ============================================================================
+
+class SourcesTest(TestCase):
+    def test_import_names(self):
+        scss = """
+            @import "a", 'b';
+            // @import "commented";
+            /* @import "also-commented"; */
+            @import url(foo.css);
+            @import "http://example.com/remote";
+            @import "plain.css";
+            @import "c/d"; @import "e";
+        """
+        self.assertEqual(['a', 'b', 'c/d', 'e'], import_names(scss))
+
+        sass = '$x: 1\n@import "a"\n@import b, c\n'
+        self.assertEqual(['a', 'b', 'c'], import_names(sass))
+
+    def test_graph(self):
+        with temp_directory() as dir_name:
+            os.mkdir(os.path.join(dir_name, 'sub'))
+            files = {
+                'main.sass':'@import "one"\n@import "sub/two"\n',
+                '_one.scss':'@import "sub/two"; @import "missing";',
+                'sub/two.scss':'@import "three.scss";',
+                'sub/_three.scss':'.x { color: red; }',
+                'unused.scss':'',
+            }
+            for name, content in files.items():
+                with open(os.path.join(dir_name, name), 'w') as f:
+                    f.write(content)
+
+            main = os.path.join(dir_name, 'main.sass')
+            one = os.path.join(dir_name, '_one.scss')
+            two = os.path.join(dir_name, 'sub/two.scss')
+            three = os.path.join(dir_name, 'sub/_three.scss')
+
+            # partial resolution
+            self.assertEqual(one, resolve_import('one', dir_name))
+            self.assertEqual(three, resolve_import('sub/three', dir_name))
+            self.assertEqual(None, resolve_import('missing', dir_name))
+
+            expected = [
+                (main, [one, two]),
+                (one, [two]),
+                (two, [three]),
+                (three, []),
+            ]
+            self.assertEqual(expected, list(import_graph(main).items()))
+
+            # records
+            record = SourceRecord.scan(main)
+            self.assertTrue(record.is_current())
+            fingerprint = record.fingerprint
+
+            loaded = SourceRecord.from_json(record.to_json())
+            self.assertEqual(record.files, loaded.files)
+            self.assertEqual(fingerprint, loaded.fingerprint)
+
+            # touching means not current but same fingerprint
+            os.utime(three, (1, 1))
+            self.assertFalse(record.is_current())
+            self.assertEqual(fingerprint, SourceRecord.scan(main).fingerprint)
+
+            # files outside the graph don't matter
+            with open(os.path.join(dir_name, 'unused.scss'), 'w') as f:
+                f.write('.y { color: blue; }')
+            self.assertEqual(fingerprint, SourceRecord.scan(main).fingerprint)
+
+            # content changes do
+            with open(three, 'w') as f:
+                f.write('.x { color: blue; }')
+            self.assertNotEqual(fingerprint,
+                SourceRecord.scan(main).fingerprint)
+
+            # removed files aren't current
+            record = SourceRecord.scan(main)
+            os.remove(three)
+            self.assertFalse(record.is_current())
+
+    def test_bootstrap(self):
+        graph = import_graph(os.path.join(BOOTSTRAP_DIR, 'custom.sass'))
+        names = [os.path.relpath(name, BOOTSTRAP_DIR) for name in graph]
+
+        self.assertEqual(['custom.sass', '_bootstrap.scss',
+            'bootstrap/_variables.scss'], names[:3])
+        self.assertIn('bootstrap/mixins/_buttons.scss', names)
+        self.assertNotIn('bootstrap/_theme.scss', names)
+
+    def test_bundle(self):
+        with temp_directory() as dir_name:
+            files = {
+                'main.sass':'$x: #f00\n\n// comment\n@import "one"\n',
+                '_one.scss':("/* @import 'nope'; */\n"
+                    '@import url(foo.css), "two";\n.a { color: $x; }'),
+                '_two.scss':'.b { color: darken($x, 10%); }',
+                'nested.sass':'.a\n  color: red\n',
+                'missing.scss':'@import "three";',
+            }
+            for name, content in files.items():
+                with open(os.path.join(dir_name, name), 'w') as f:
+                    f.write(content)
+
+            main = os.path.join(dir_name, 'main.sass')
+            flat = SourceBundle(main).flatten()
+            self.assertNotIn('@import "', flat)
+            self.assertIn('@import url(foo.css);', flat)
+
+            expected = sass.compile(string='@import "%s";' % main)
+            self.assertEqual(expected, sass.compile(string=flat))
+
+            # unbundleable chains are compiled from disk
+            for name in ['nested.sass', 'missing.scss']:
+                filename = os.path.join(dir_name, name)
+                with self.assertRaises(Unbundleable):
+                    SourceBundle(filename).flatten()
+
+                self.assertEqual(None, bundled_source(filename, 'x'))
+
+            # chains can be scanned unless an import is missing
+            scanned = chain_source(main)
+            self.assertIn('$x: #f00;', scanned)
+            self.assertIn('darken($x, 10%)', scanned)
+            self.assertIn('color: red;', chain_source(os.path.join(dir_name,
+                'nested.sass')))
+            self.assertEqual(None, chain_source(os.path.join(dir_name,
+                'missing.scss')))
+
+            # bundles are only read once per fingerprint
+            self.assertEqual(flat, bundled_source(main, 'a'))
+            os.remove(main)
+            self.assertEqual(flat, bundled_source(main, 'a'))
+
+    def test_bootstrap_bundle(self):
+        filename = os.path.join(BOOTSTRAP_DIR, 'custom.sass')
+        src = '$bootstrap-sass-asset-helper:false;\n'
+
+        expected = sass.compile(string=src + '@import "%s";' % filename)
+        flat = SourceBundle(filename).flatten()
+        self.assertEqual(expected, sass.compile(string=src + flat))
@@ -0,0 +1,180 @@
+import itertools, mock, sass
+
+from django.test import TestCase, override_settings
+
+from bseditor.cache import get_store
+from bseditor.conv import BStrapVars
+from bseditor.models import Version, Sheet
+from bseditor.pool import PoolError
+from bseditor.splice import (complex_names, cached_template, template_cache,
+    SpliceError, SpliceTemplate)
+from bseditor.tests.sampledata import (VARS_FILE, VARS_STORE_JSON, SASS_FILE,
+    EXPECTED_SASS_FILE, SASS_FILE_CUSTOMIZED_DICT)
+from bseditor.tests.utils import BSEditorTest, create_fakestrap
+
+EXTRA_SASS = """
+.btn {
+    border-color: darken($navbar-inverse-bg, 10%);
+}
+"""
+
+# ============================================================================
+# Test Class
+# ============================================================================
+
+class SpliceTest(TestCase):
+    def test_complex_names(self):
+        source = """
+            // $commented: 1;
+            $a: #fff !default;
+            $b: $a;
+            .x {
+                color: $c;
+                background: darken($d, 10%);
+                $local: #000 !default;
+                @if $e { border: 0; }
+                #{$f} { margin: 0; }
+            }
+        """
+        expected = set(['a', 'b', 'd', 'e', 'f', 'local'])
+        self.assertEqual(expected, complex_names(source))
+
+    def test_template(self):
+        count = [0]
+        def compile_values(values):
+            count[0] += 1
+            bsv = BStrapVars.factory(VARS_STORE_JSON, overrides=values)
+            src = ['$%s:%s;' % pair for pair in bsv.all_value_pairs()]
+            src.extend([SASS_FILE, EXTRA_SASS])
+            return sass.compile(string='\n'.join(src))
+
+        bsv = BStrapVars.factory(VARS_STORE_JSON)
+
+        # gray-base isn't in the output but only reaches it through a
+        # simple variable
+        template = SpliceTemplate.build(compile_values, bsv,
+            SASS_FILE + EXTRA_SASS)
+        expected = set(['gray-base', 'body-bg', 'text-color'])
+        self.assertEqual(expected, template.simple)
+        self.assertEqual(compile_values({}), template.render(
+            bsv.colour_values))
+
+        # source scanning saves compiles
+        builds = count[0]
+        count[0] = 0
+        template = SpliceTemplate.build(compile_values, bsv,
+            VARS_FILE + SASS_FILE + EXTRA_SASS)
+        self.assertTrue(count[0] < builds)
+        # text-color is reassigned in the variables file
+        self.assertEqual(set(['body-bg']), template.simple)
+
+        # no template without the source
+        with self.assertRaises(SpliceError):
+            SpliceTemplate.build(compile_values, bsv, None)
+
+        loaded = SpliceTemplate.from_json(template.to_json())
+        self.assertEqual(template.parts, loaded.parts)
+        self.assertEqual(template.simple, loaded.simple)
+
+        # simple changes match a compile, anything else needs one
+        for custom in [{'body-bg':'#123456'}, {'body-bg':'red'}]:
+            bsv = BStrapVars.factory(VARS_STORE_JSON, custom)
+            self.assertEqual(compile_values(custom),
+                template.render_vars(bsv))
+
+        for custom in [{'navbar-inverse-bg':'#123456'}, {'text-color':'red'},
+                {'gray-base':'#111'}]:
+            bsv = BStrapVars.factory(VARS_STORE_JSON, custom)
+            self.assertEqual(None, template.render_vars(bsv))
+
+        # templates that don't reproduce the base fail
+        outputs = itertools.count()
+        def broken(values):
+            return '.x%d { color: red; }' % next(outputs)
+
+        with self.assertRaises(SpliceError):
+            SpliceTemplate.build(broken, BStrapVars.factory(VARS_STORE_JSON),
+                SASS_FILE)
+
+        # failures are remembered
+        build = mock.Mock(side_effect=SpliceError('nope'))
+        self.assertEqual(None, cached_template('x', build))
+        self.assertEqual(None, cached_template('x', build))
+        self.assertEqual(1, build.call_count)
+
+        # an unavailable compiler isn't
+        build = mock.Mock(side_effect=PoolError('busy'))
+        with mock.patch('bseditor.splice.logger') as logger:
+            self.assertEqual(None, cached_template('y', build))
+            self.assertEqual(None, cached_template('y', build))
+            self.assertEqual(2, logger.warning.call_count)
+
+        self.assertEqual(2, build.call_count)
+
+
+    def test_branches(self):
+        # a variable only used in a lightness test
+        source = ('.b{color:$x} @if lightness($x) > 50% {.a{color:black}} '
+            '@else {.a{color:white}}')
+        data = {'nonsections':{'x':{'value':'#333'}}}
+        store = BStrapVars.factory(data).base_to_json(colours=True)
+
+        def compile_values(values):
+            bsv = BStrapVars.factory(store, overrides=values)
+            src = ['$%s:%s;' % pair for pair in bsv.all_value_pairs()]
+            src.append(source)
+            return sass.compile(string='\n'.join(src))
+
+        # the scan finds it
+        bsv = BStrapVars.factory(store)
+        template = SpliceTemplate.build(compile_values, bsv, source)
+        self.assertEqual(set([]), template.simple)
+
+        # sentinels find it when the scan doesn't
+        template = SpliceTemplate.build(compile_values, bsv, '')
+        self.assertEqual(set([]), template.simple)
+
+        bsv = BStrapVars.factory(store, {'x':'#eee'})
+        self.assertEqual(None, template.render_vars(bsv))
+
+
+class SpliceSheetTest(BSEditorTest):
+    def test_sheet(self):
+        get_store().clear()
+        template_cache.clear()
+
+        compile_filename, variables_filename = create_fakestrap(self.dir_name)
+        version = Version.factory('v1', variables_filename, compile_filename)
+        sheet = Sheet.factory('s1', version, SASS_FILE_CUSTOMIZED_DICT)
+
+        # off by default
+        self.assertEqual(None, version.splice_template())
+
+        with override_settings(BSEDITOR_SPLICE_ENGINE=True):
+            template = version.splice_template()
+            self.assertEqual(set(['body-bg', 'navbar-inverse-bg']),
+                template.simple)
+
+            with mock.patch('bseditor.cache.sass.compile') as patched:
+                self.assertEqual(EXPECTED_SASS_FILE, sheet.compiled_string())
+                self.assertEqual(0, patched.call_count)
+
+            # templates are shared through the store
+            template_cache.clear()
+            with mock.patch('bseditor.cache.sass.compile') as patched:
+                self.assertEqual(template.parts,
+                    version.splice_template().parts)
+                self.assertEqual(0, patched.call_count)
+
+            # with background jobs on the request doesn't wait for the build
+            get_store().clear()
+            template_cache.clear()
+            with mock.patch('bseditor.splice.submit') as patched:
+                self.assertEqual(None, version.splice_template())
+                self.assertEqual(None, version.splice_template())
+                self.assertEqual(1, patched.call_count)
+
+                # ready once the job has run
+                patched.call_args[0][0]()
+                self.assertEqual(template.parts,
+                    version.splice_template().parts)
@@ -1,12 +1,15 @@
 import json, os, mock, copy
+from datetime import timedelta
 
 from django.contrib import messages
 from django.test import override_settings
+from django.utils import timezone
 from awl.utils import refetch
 from awl.waelsteng import AdminToolsMixin, messages_from_response
 
+from bseditor.admin import DeployJobAdmin
 from bseditor.conv import ordered_json
-from bseditor.models import Version, Sheet, PreviewSheet
+from bseditor.models import Version, Sheet, PreviewSheet, DeployJob
 from bseditor.tests.sampledata import (EXPECTED_SASS_PREVIEW_FILE,
     SASS_FILE_CUSTOMIZED_DICT, SASS_FILE_OVERRIDES_DICT)
 
@@ -51,6 +54,29 @@ class ViewsTest(BSEditorTest, AdminToolsMixin):
             sheet = refetch(sheet)
             self.assertEqual(expected, sheet.get_vars().custom_values)
 
+            # deploy job status
+            result = json.loads(response.content.decode('utf-8'))
+            response = self.authed_get(result['status_url'])
+            result = json.loads(response.content.decode('utf-8'))
+            self.assertEqual('done', result['status'])
+            self.assertTrue(result['finished'])
+            self.assertTrue(result['duration'] >= 0)
+
+            # jobs lost by an exiting process fail after the timeout
+            job = DeployJob.objects.create(sheet=sheet)
+            url = '/bseditor/deploy_status/%s/' % job.id
+            response = self.authed_get(url)
+            result = json.loads(response.content.decode('utf-8'))
+            self.assertEqual('queued', result['status'])
+
+            DeployJob.objects.filter(id=job.id).update(
+                created=timezone.now() - timedelta(seconds=600))
+            response = self.authed_get(url)
+            result = json.loads(response.content.decode('utf-8'))
+            self.assertEqual('failed', result['status'])
+            self.assertTrue(result['finished'])
+            self.assertIn('300 seconds', result['message'])
+
             # force an error when saving to check error handling (error
             # message should be added to existing message queue)
             with mock.patch('bseditor.views.Sheet.save') as patched:
@@ -63,6 +89,13 @@ class ViewsTest(BSEditorTest, AdminToolsMixin):
                 self.assertEqual(2, len(results))
                 self.assertEqual(messages.ERROR, results[1][1])
 
+            # jobs are shown in the admin, visiting it uses up the queued
+            # messages so this comes after the message checks
+            job_admin = DeployJobAdmin(DeployJob, self.site)
+            self.assertIn('Sheet(id=%s' % sheet.id, self.field_value(
+                job_admin, job, 'show_sheet'))
+            self.visit_admin_link(job_admin, job, 'show_sheet')
+
         # --------------------------
         # -- ajax_colour_value view
         payload = {
@@ -125,6 +158,47 @@ class ViewsTest(BSEditorTest, AdminToolsMixin):
         result = json.loads(response.content.decode('utf-8'))
         self.assertFalse(result['success'])
 
+        # --------------------------
+        # -- ajax_colour_values view
+        payload = {
+            'version':version.id,
+            'overrides':{
+                'gray-base':'#00f',
+                'body-bg':'foo',
+            },
+            'changed':['gray-base', 'body-bg'],
+        }
+        data = { 'payload':json.dumps(payload), }
+
+        response = self.authed_post('/bseditor/ajax_colour_values/', data)
+        result = json.loads(response.content.decode('utf-8'))
+        self.assertTrue(result['success'])
+        self.assertEqual('#00f', result['colours']['gray-base'])
+        self.assertEqual('#00f', result['colours']['text-color'])
+        self.assertEqual(['body-bg'], result['invalid'])
+
+        # editor asks for the affected colours using the graph in the page
+        response = self.authed_get('/bseditor/edit_sheet/%s/' % sheet.id)
+        dependents = json.loads(response.context['dependents'])
+        self.assertIn('text-color', dependents['gray-base'])
+
+        payload['colours'] = ['gray-base']
+        data = { 'payload':json.dumps(payload), }
+
+        response = self.authed_post('/bseditor/ajax_colour_values/', data)
+        result = json.loads(response.content.decode('utf-8'))
+        self.assertTrue(result['success'])
+        self.assertEqual({'gray-base':'#00f'}, result['colours'])
+        self.assertEqual([], result['invalid'])
+
+        # missing changed key, should return success=False
+        del payload['changed']
+        data = { 'payload':json.dumps(payload), }
+
+        response = self.authed_post('/bseditor/ajax_colour_values/', data)
+        result = json.loads(response.content.decode('utf-8'))
+        self.assertFalse(result['success'])
+
         # --------------------------
         # -- preview_css view
         preview = PreviewSheet.factory(sheet, SASS_FILE_OVERRIDES_DICT)
@@ -132,10 +206,95 @@ class ViewsTest(BSEditorTest, AdminToolsMixin):
         self.assertEqual(EXPECTED_SASS_PREVIEW_FILE,
             response.content.decode('utf-8'))
 
+        # compiled css is stored and served with validators
+        preview = refetch(preview)
+        self.assertEqual(EXPECTED_SASS_PREVIEW_FILE, preview.css)
+        etag = response['ETag']
+        self.assertEqual('"%s"' % preview.css_digest, etag)
+
+        url = '/bseditor/preview_css/%s/' % preview.id
+        with mock.patch('bseditor.models.Sheet.compiler') as patched:
+            self.authed_get(url, response_code=304,
+                headers={'HTTP_IF_NONE_MATCH':etag})
+            self.authed_get(url, response_code=304,
+                headers={'HTTP_IF_MODIFIED_SINCE':response['Last-Modified']})
+            self.authed_get(url, headers={'HTTP_IF_NONE_MATCH':'"other"'})
+            self.assertFalse(patched.called)
+
+        # changing the sheet means a new compile
+        sheet.save()
+        with mock.patch('bseditor.models.compile_sass') as patched:
+            patched.return_value = 'changed'
+            response = self.authed_get(url,
+                headers={'HTTP_IF_NONE_MATCH':etag})
+            self.assertEqual(b'changed', response.content)
+
+        # so does changing the Sass files of the Version, which are checked
+        # when the fingerprint is refreshed
+        etag = response['ETag']
+        Version.objects.filter(id=version.id).update(
+            fingerprint='changed-sources')
+        with mock.patch('bseditor.models.compile_sass') as patched:
+            patched.return_value = 'new sources'
+            response = self.authed_get(url,
+                headers={'HTTP_IF_NONE_MATCH':etag})
+            self.assertEqual(b'new sources', response.content)
+
+        preview = refetch(preview)
+        self.assertEqual(version.source_fingerprint(),
+            preview.css_fingerprint)
+
         # --------------------------
         # -- preview_sheet view
         response = self.authed_get('/bseditor/preview_sheet/%s/' % preview.id)
         self.assertTemplateUsed(response, 'bseditor/preview_sheet.html')
+        self.assertEqual('', response.context['preview_events_url'])
+
+        with override_settings(BSEDITOR_PREVIEW_EVENTS=True):
+            response = self.authed_get(
+                '/bseditor/preview_sheet/%s/' % preview.id)
+            self.assertEqual('/bseditor/preview_events/%s/' % preview.id,
+                response.context['preview_events_url'])
+
+        # --------------------------
+        # -- preview_events view
+        preview = refetch(preview)
+        url = '/bseditor/preview_events/%s/' % preview.id
+
+        # streams are off by default
+        self.authed_get(url, response_code=404)
+
+        # too many open streams
+        with override_settings(BSEDITOR_PREVIEW_EVENTS=True,
+                BSEDITOR_PREVIEW_EVENT_STREAMS=0):
+            self.authed_get(url, response_code=503)
+
+        with override_settings(BSEDITOR_PREVIEW_EVENTS=True,
+                BSEDITOR_PREVIEW_EVENT_STREAMS=1), \
+                mock.patch('bseditor.views.EVENT_DURATION', 0):
+            # a stream holds its slot until the response is closed
+            response = self.authed_get(url)
+            self.authed_get(url, response_code=503)
+            response.close()
+
+            # page is up to date, nothing to send
+            response = self.authed_get(url + '?digest=' + preview.css_digest)
+            self.assertEqual('text/event-stream', response['Content-Type'])
+            content = b''.join(response.streaming_content).decode('utf-8')
+            self.assertNotIn('event: css', content)
+            response.close()
+
+            # page has older css
+            response = self.authed_get(url,
+                headers={'HTTP_LAST_EVENT_ID':'older'})
+            content = b''.join(response.streaming_content).decode('utf-8')
+            self.assertIn('id: %s\nevent: css\n' % preview.css_digest,
+                content)
+            data = json.loads(content.split('data: ')[1].split('\n')[0])
+            self.assertEqual(preview.css_digest, data['digest'])
+            self.assertEqual('/bseditor/preview_css/%s/?%s' % (preview.id,
+                preview.css_digest), data['url'])
+            response.close()
 
         # --------------------------
         # -- ajax_save_preview view
@@ -155,6 +314,19 @@ class ViewsTest(BSEditorTest, AdminToolsMixin):
         self.assertTrue(result['success'])
         self.assertEqual('/bseditor/preview_sheet/%s/' % previews[0].id, 
             result['preview_url'])
+        self.assertEqual(previews[0].css_digest, result['css_digest'])
+        self.assertEqual('/bseditor/preview_css/%s/?%s' % (previews[0].id,
+            previews[0].css_digest), result['css_url'])
+
+        # the preview page checks for changes with a HEAD request
+        url = '/bseditor/preview_css/%s/' % previews[0].id
+        response = self.client.head(url,
+            HTTP_IF_NONE_MATCH='"%s"' % previews[0].css_digest)
+        self.assertEqual(304, response.status_code)
+        response = self.client.head(url, HTTP_IF_NONE_MATCH='"older"')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('"%s"' % previews[0].css_digest, response['ETag'])
+        self.assertEqual(b'', response.content)
 
         # force an error when saving to check error handling 
         with mock.patch('bseditor.views.PreviewSheet.save') as patched:
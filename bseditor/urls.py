@@ -5,8 +5,12 @@ urlpatterns = patterns('bseditor.views',
     url(r'edit_sheet/(\d+)/$', 'edit_sheet', name='bseditor-edit-sheet'),
     url(r'ajax_colour_value/$', 'ajax_colour_value',
         name='bseditor-ajax-colour-value'),
+    url(r'ajax_colour_values/$', 'ajax_colour_values',
+        name='bseditor-ajax-colour-values'),
     url(r'ajax_save_sheet/(\d+)/$', 'ajax_save_sheet',
         name='bseditor-ajax-save-sheet'),
+    url(r'deploy_status/(\d+)/$', 'deploy_status',
+        name='bseditor-deploy-status'),
 
     # admin patterns
     url(r'show_version_variables/(\d+)/$', 'show_version_variables', 
@@ -19,6 +23,8 @@ urlpatterns = patterns('bseditor.views',
     url(r'preview_sheet/(\d+)/$', 'preview_sheet', 
         name='bseditor-preview-sheet'),
     url(r'preview_css/(\d+)/$', 'preview_css', ),
+    url(r'preview_events/(\d+)/$', 'preview_events',
+        name='bseditor-preview-events'),
     url(r'show_saved_sheet_preview/(\d+)/$', 'show_saved_sheet_preview', 
         name='bseditor-preview-saved'),
     url(r'ajax_save_preview/(\d+)/$', 'ajax_save_preview',
@@ -1,19 +1,24 @@
-import json, logging, sass
+import json, logging, sass, threading, time
+from calendar import timegm
 
+from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.core.urlresolvers import reverse
 from django.db import transaction
 from django.db.utils import IntegrityError
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.http import (Http404, HttpResponse, HttpResponseRedirect,
+    HttpResponseNotModified, JsonResponse, StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
+from django.utils.http import (http_date, parse_etags, parse_http_date_safe,
+    quote_etag)
 from django.views.decorators.csrf import csrf_exempt
 
 from awl.decorators import post_required
 from awl.utils import render_page
 
 from .conv import BStrapVars, ordered_json
-from .models import Sheet, Version, PreviewSheet
+from .models import Sheet, Version, PreviewSheet, DeployJob
 
 logger = logging.getLogger(__name__)
 
@@ -24,12 +29,14 @@ logger = logging.getLogger(__name__)
 @staff_member_required
 def edit_sheet(request, sheet_id):
     sheet = get_object_or_404(Sheet, id=sheet_id)
+    bsv = sheet.get_vars()
 
     data = {
         'sheet':sheet,
-        'bstrap_vars':sheet.get_vars(),
+        'bstrap_vars':bsv,
+        'dependents':json.dumps(bsv.graph.adjacency()),
         'cancel_url':reverse('admin:bseditor_sheet_changelist'),
-        'ajax_colour_value_url':reverse('bseditor-ajax-colour-value'),
+        'ajax_colour_values_url':reverse('bseditor-ajax-colour-values'),
         'ajax_save_sheet':reverse('bseditor-ajax-save-sheet', args=(sheet.id,)),
         'ajax_save_preview':reverse('bseditor-ajax-save-preview', 
             args=(sheet.id,)),
@@ -45,18 +52,54 @@ def ajax_save_sheet(request, sheet_id):
     sheet = get_object_or_404(Sheet, id=sheet_id)
 
     payload = ordered_json(request.POST['payload'])
+    data = {}
 
     try:
         sheet.name = payload['name']
         sheet._store = json.dumps(payload['custom'])
         sheet.save()
-        sheet.deploy()
-        messages.success(request, 'Saved & deployed %s' % sheet.filename)
+
+        # deploy in the background, the editor polls the status url
+        job = DeployJob.enqueue(sheet)
+        data['status_url'] = reverse('bseditor-deploy-status',
+            args=(job.id,))
+        _deploy_message(request, job, 'Saved & deployed %s',
+            'Saved %s, deploying')
     except Exception as e:
         logger.exception('Error saving sheet!')
         messages.error(request, 'Error: %s' % str(e))
 
-    return JsonResponse({})
+    return JsonResponse(data)
+
+
+def _deploy_message(request, job, done_msg, queued_msg):
+    # jobs that ran inline have already finished
+    if job.status == DeployJob.DONE:
+        messages.success(request, done_msg % job.sheet.filename)
+    elif job.status == DeployJob.FAILED:
+        messages.error(request, 'Error deploying: %s' % job.message)
+    else:
+        messages.info(request, queued_msg % job.sheet.filename)
+
+
+@staff_member_required
+def deploy_status(request, job_id):
+    """Returns JSON describing a :class:`DeployJob`, polled by the editor
+    after saving.
+
+    @param job_id: ID of :class:`DeployJob` object
+    """
+    DeployJob.expire_lost()
+    job = get_object_or_404(DeployJob, id=job_id)
+
+    return JsonResponse({
+        'id':job.id,
+        'sheet':job.sheet_id,
+        'status':job.status,
+        'finished':job.is_finished,
+        'message':job.message,
+        'duration':job.duration,
+    })
 
 
 @staff_member_required
@@ -70,18 +113,27 @@ def ajax_colour_value(request):
     Returns a JSON dictionary with a key "success" that is guaranteed to be
     there.  If the colour value is convertible then another key "colour" will
     contain the result.
+
+    The editor uses :func:`ajax_colour_values` to update its swatches in a
+    single request, this view is kept for compatibility with existing
+    callers.
     """
     payload = ordered_json(request.POST['payload'])
     sass_variable = payload['sass_variable']
     version = get_object_or_404(Version, id=payload['version'])
-    content = ordered_json(version._store)
     data = {
         'success':False,
         'colours':{},
     }
 
     try:
-        bsv = BStrapVars.factory(content, overrides=payload['overrides'])
+        # an empty override means the base value, adding one for the
+        # requested variable makes sure it gets evaluated rather than read
+        # from the colours stored in the Version
+        overrides = payload['overrides']
+        overrides.setdefault(sass_variable, '')
+
+        bsv = BStrapVars.factory(version._store, overrides=overrides)
         data['colours'][sass_variable] = bsv.colour_values[sass_variable]
         
         # update any other colours dependent on this variable
@@ -100,6 +152,62 @@ def ajax_colour_value(request):
 
     return JsonResponse(data)
 
+
+@staff_member_required
+@csrf_exempt
+@post_required(['payload'])
+def ajax_colour_values(request):
+    """AJAX method for evaluating a batch of CSS colour values within the
+    Bootstrap context in a single pass.  Expects an "overrides" dictionary
+    of variable names to the values to try and a "changed" list with the
+    names of the variables whose colours are wanted.
+
+    The editor knows the dependency graph and sends a "colours" list with
+    the names of the colour variables affected by the change.  If it is
+    missing the changed variables and everything dependent on them are
+    used instead.
+
+    Returns a JSON dictionary with a key "success" that is guaranteed to be
+    there.  If the values could be evaluated then "colours" contains the
+    value of each requested variable that is a colour and "invalid" lists
+    the changed variables that aren't colours.
+    """
+    payload = ordered_json(request.POST['payload'])
+    version = get_object_or_404(Version, id=payload['version'])
+    data = {
+        'success':False,
+        'colours':{},
+        'invalid':[],
+    }
+
+    try:
+        # an empty override means the base value, see ajax_colour_value
+        overrides = payload['overrides']
+        changed = payload['changed']
+        for name in changed:
+            overrides.setdefault(name, '')
+
+        bsv = BStrapVars.factory(version._store, overrides=overrides)
+        colours = bsv.colour_values
+
+        wanted = payload.get('colours')
+        if wanted is None:
+            wanted = list(changed)
+            for name in changed:
+                wanted.extend(sorted(bsv.dependencies(name)))
+
+        for name in wanted:
+            if name in colours:
+                data['colours'][name] = colours[name]
+            elif name in changed and name not in data['invalid']:
+                data['invalid'].append(name)
+
+        data['success'] = True
+    except (sass.CompileError, KeyError):
+        pass
+
+    return JsonResponse(data)
+
 # ============================================================================
 # Admin Methods
 # ============================================================================
@@ -119,12 +227,9 @@ def show_version_variables(request, version_id):
 def deploy_sheet(request, sheet_id):
     sheet = get_object_or_404(Sheet, id=sheet_id)
 
-    try:
-        sheet.deploy()
-        messages.success(request, 'Deployed %s' % sheet.filename)
-    except Exception as e:
-        logger.exception('Error in deploy!')
-        messages.error(request, 'Error deploying: %s' % str(e))
+    job = DeployJob.enqueue(sheet)
+    _deploy_message(request, job, 'Deployed %s',
+        'Deploying %s, the result is shown in the deploy jobs')
 
     url = reverse('admin:bseditor_sheet_changelist')
     return HttpResponseRedirect(url)
@@ -163,13 +268,43 @@ def create_sheet(request, version_id):
 
 def preview_css(request, preview_sheet_id):
     """Returns CSS based on the compiled SASS content of the given
-    :class:`PreviewSheet` object
+    :class:`PreviewSheet` object.  The CSS stored on the object is served
+    with an ETag and Last-Modified time, conditional requests that match
+    get a 304.  The preview, its sheet and Version are read in one query and
+    nothing is compiled unless the stored CSS is stale.
 
     @param preview_sheet_id: ID of :class:`PreviewSheet` object
     """
-    preview = get_object_or_404(PreviewSheet, id=preview_sheet_id)
-
-    return HttpResponse(preview.content(), content_type='text/css')
+    preview = get_object_or_404(
+        PreviewSheet.objects.select_related('sheet__version'),
+        id=preview_sheet_id)
+    if preview.is_stale:
+        preview.compile()
+
+    etag = quote_etag(preview.css_digest)
+    last_modified = timegm(preview.compiled.utctimetuple())
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        not_modified = '*' in etags or preview.css_digest in etags
+    elif if_modified_since:
+        since = parse_http_date_safe(if_modified_since)
+        not_modified = since is not None and last_modified <= since
+    else:
+        not_modified = False
+
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(preview.css, content_type='text/css')
+
+    # browsers always check back as the preview can change at any time
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 
 def preview_sheet(request, preview_sheet_id):
@@ -178,15 +313,157 @@ def preview_sheet(request, preview_sheet_id):
 
     @param preview_sheet_id: ID of :class:`PreviewSheet` object
     """
-    preview = get_object_or_404(PreviewSheet, id=preview_sheet_id)
+    preview = get_object_or_404(
+        PreviewSheet.objects.select_related('sheet__version'),
+        id=preview_sheet_id)
+
+    # preview_css only compares the stored fingerprint, check the Sass files
+    # when the page is loaded so changes to them are picked up
+    preview.sheet.version.source_fingerprint()
+
+    # compile now so the page knows which CSS it starts with and only looks
+    # for later changes
+    preview.content()
+
     data = {
         'preview':preview,
-        'preview_css_url':reverse('bseditor-preview-css', args=(preview.id,))
+        'preview_css_url':reverse('bseditor-preview-css', args=(preview.id,)),
+        'preview_events_url':'',
     }
+    if getattr(settings, 'BSEDITOR_PREVIEW_EVENTS', False):
+        data['preview_events_url'] = reverse('bseditor-preview-events',
+            args=(preview.id,))
 
     return render_page(request, 'bseditor/preview_sheet.html', data)
 
 
+# ----------------------------------------------------------------------------
+# Preview Events
+#
+# The editor tells the preview window it opened about new compiles through
+# window.postMessage, which needs no connection to the server.  Setting
+# BSEDITOR_PREVIEW_EVENTS = True also pushes them over server-sent events,
+# so previews not opened by the editor are updated too.  Each open stream
+# holds a request worker, so only turn this on with a threaded or
+# asynchronous server.  BSEDITOR_PREVIEW_EVENT_STREAMS limits the number of
+# streams open at once in a process.  Previews that get neither fall back
+# to a HEAD request on preview_css with their ETag every few seconds.
+
+# seconds between checks for a new compile, the length of a single event
+# stream and the reconnection delay requested from the browser
+EVENT_INTERVAL = 1
+EVENT_DURATION = 30
+EVENT_RETRY = 1000
+
+DEFAULT_EVENT_STREAMS = 4
+
+_streams_lock = threading.Lock()
+_open_streams = 0
+
+
+class EventStream(object):
+    """Iterable of the events for a streaming response that holds one of the
+    BSEDITOR_PREVIEW_EVENT_STREAMS slots until the response is closed.
+    Create it with :func:`EventStream.open`.
+
+    :param events: iterator of the events to send
+    """
+    def __init__(self, events):
+        self.events = events
+        self.closed = False
+
+    @classmethod
+    def open(cls, events):
+        """Returns a new stream or None if the streams are all in use."""
+        global _open_streams
+
+        limit = getattr(settings, 'BSEDITOR_PREVIEW_EVENT_STREAMS',
+            DEFAULT_EVENT_STREAMS)
+        with _streams_lock:
+            if _open_streams >= limit:
+                return None
+
+            _open_streams += 1
+
+        return cls(events)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def close(self):
+        global _open_streams
+
+        if self.closed:
+            return
+
+        self.closed = True
+        self.events.close()
+        with _streams_lock:
+            _open_streams -= 1
+
+
+def _preview_events(preview_id, digest, css_url):
+    # the stream is kept short so that it doesn't tie up a worker, the
+    # browser reconnects with the id of the last event it saw
+    yield 'retry: %s\n\n' % EVENT_RETRY
+
+    end = time.time() + EVENT_DURATION
+    while True:
+        current = PreviewSheet.objects.filter(id=preview_id).values_list(
+            'css_digest', flat=True).first()
+        if current is None:
+            return
+
+        if current and current != digest:
+            digest = current
+            data = json.dumps({
+                'digest':digest,
+                'url':'%s?%s' % (css_url, digest),
+            })
+            yield 'id: %s\nevent: css\ndata: %s\n\n' % (digest, data)
+
+        if time.time() >= end:
+            return
+
+        time.sleep(EVENT_INTERVAL)
+
+        # comments keep proxies from timing out and notice closed streams
+        yield ':\n\n'
+
+
+@staff_member_required
+def preview_events(request, preview_sheet_id):
+    """Server-sent event stream for a :class:`PreviewSheet`.  A "css" event
+    is sent whenever the sheet is compiled with new values, its data is a
+    JSON dictionary with the "digest" of the CSS and the "url" to load it
+    from.  The starting digest is taken from the Last-Event-ID header or
+    the "digest" query parameter.
+
+    Returns a 404 unless the BSEDITOR_PREVIEW_EVENTS setting is on and a
+    503 if too many streams are open.
+
+    @param preview_sheet_id: ID of :class:`PreviewSheet` object
+    """
+    if not getattr(settings, 'BSEDITOR_PREVIEW_EVENTS', False):
+        raise Http404('Preview events are turned off')
+
+    preview = get_object_or_404(PreviewSheet, id=preview_sheet_id)
+    digest = request.META.get('HTTP_LAST_EVENT_ID',
+        request.GET.get('digest', ''))
+    css_url = reverse('bseditor-preview-css', args=(preview.id,))
+
+    stream = EventStream.open(_preview_events(preview.id, digest, css_url))
+    if stream is None:
+        return HttpResponse('Too many preview streams', status=503,
+            content_type='text/plain')
+
+    response = StreamingHttpResponse(stream,
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @staff_member_required
 def show_saved_sheet_preview(request, sheet_id):
     """Given a :class:`Sheet` object, reset any associated 
@@ -198,6 +475,7 @@ def show_saved_sheet_preview(request, sheet_id):
     try:
         preview = PreviewSheet.objects.get(sheet=sheet)
         preview._store = ''
+        preview.css_digest = ''
         preview.save()
     except PreviewSheet.DoesNotExist:
         preview = PreviewSheet.objects.create(sheet=sheet)
@@ -215,6 +493,9 @@ def ajax_save_preview(request, sheet_id):
     stored in a :class:`PreviewSheet` associated with the given
     :class:`Sheet`.
 
+    The response includes the URL of the new CSS so the editor can pass it
+    on to an open preview window.
+
     @param sheet_id: ID of :class`Sheet` object to associate a
         :class:`PreviewSheet` with
     """
@@ -230,12 +511,15 @@ def ajax_save_preview(request, sheet_id):
         preview = PreviewSheet.objects.create(sheet=sheet)
 
     try:
+        # compiling triggers any errors, the result is kept for preview_css
         preview._store = json.dumps(payload.get('overrides', '{}'))
-        preview.save()
-        preview.content()   # trigger any compilation errors
+        preview.compile()
         data['success'] = True
         data['preview_url'] = reverse('bseditor-preview-sheet', 
             args=(preview.id,))
+        data['css_digest'] = preview.css_digest
+        data['css_url'] = '%s?%s' % (reverse('bseditor-preview-css',
+            args=(preview.id,)), preview.css_digest)
     except Exception as e:
         data['msg'] = str(e)
 
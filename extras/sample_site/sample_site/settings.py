@@ -98,7 +98,29 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'root_for_static')
 BSEDITOR_DEPLOY_DIR = os.path.join(BASE_DIR, 'deploy')
 BSEDITOR_TRACK_LAST_COMPILE = True
 #BSEDITOR_COLLECT_ON_DEPLOY = True
-#BSEDITOR_COLLECT_HOOK = 'app.collect_hook'
+#BSEDITOR_COLLECT_HOOK = 'bseditor.collect.collect_sheet'
+#BSEDITOR_COMPILE_CACHE = {
+#    'STORE':'bseditor.cache.FileStore',
+#    'OPTIONS':{
+#        'directory':os.path.join(BASE_DIR, 'compile_cache'),
+#        'max_size':100 * 1024 * 1024,
+#    },
+#}
+#BSEDITOR_BUNDLE_SOURCES = True
+#BSEDITOR_SOURCE_CHECK_INTERVAL = 60
+#BSEDITOR_SPLICE_ENGINE = True
+#BSEDITOR_COMPILE_LOCK_DIR = os.path.join(BASE_DIR, 'compile_locks')
+#BSEDITOR_DEPLOY_THREADS = 1
+#BSEDITOR_DEPLOY_TIMEOUT = 300
+# server-sent events for preview pages hold a request worker each, only turn
+# them on with a threaded or asynchronous server
+#BSEDITOR_PREVIEW_EVENTS = False
+#BSEDITOR_PREVIEW_EVENT_STREAMS = 4
+#BSEDITOR_COMPILE_POOL = {
+#    'processes':4,
+#    'timeout':30,
+#    'memory_limit':512 * 1024 * 1024,
+#}
 
 STATICFILES_DIRS = (
     BSEDITOR_DEPLOY_DIR,
@@ -43,6 +43,10 @@ def get_suite(labels=default_labels):
             os.path.abspath(os.path.join(BASE_DIR, 'bseditor/templates')),
         ),
         STATIC_URL='/static/',
+
+        # deploy jobs run inline, the test database isn't shared with
+        # background threads
+        BSEDITOR_DEPLOY_THREADS=0,
     )
 
     django.setup()